@@ -0,0 +1,586 @@
+"""
+Reading and writing of BGZF compressed files and BAM files without needing samtools or pysam. BGZF files are a series of
+small gzip blocks, so every block can be compressed or decompressed on its own. The blocks are handed to a pool of threads
+(zlib lets go of the GIL while it works) and put back in order, so the compression is no longer the slow part of a run.
+
+BAM records are turned into SAM lines as they are read and SAM lines are turned back into BAM records as they are written,
+so the rest of the deduper only ever has to work with SAM lines.
+"""
+
+import collections
+import concurrent.futures
+import io
+import struct
+import sys
+import zlib
+
+
+# The largest amount of data that goes into one block. This is what samtools/htslib uses so the blocks always fit in 64KB.
+BGZF_BLOCK_SIZE = 0xff00
+
+# Buffer size used for plain files and for stdin/stdout, so that they are read and written in large pieces
+STREAM_BUFFER_SIZE = 1 << 20
+
+# The empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# The letters for the CIGAR operations and the 4 bit bases in the order the BAM spec gives them
+CIGAR_OPS = 'MIDNSHP=X'
+SEQ_BASES = '=ACMGRSVTWYHKDBN'
+
+# Lookup tables so that each byte of the sequence turns into 2 bases in one step
+SEQ_DECODE = [SEQ_BASES[byte >> 4] + SEQ_BASES[byte & 15] for byte in range(256)]
+SEQ_ENCODE = {base: code for code, base in enumerate(SEQ_BASES)}
+
+# Turns the raw quality values into the phred+33 letters and back
+QUAL_DECODE = bytes((value + 33) & 0xff for value in range(256))
+QUAL_ENCODE = bytes((value - 33) & 0xff for value in range(256))
+
+# struct formats for the tag types
+TAG_FORMATS = {'c': '<b', 'C': '<B', 's': '<h', 'S': '<H', 'i': '<i', 'I': '<I', 'f': '<f'}
+
+
+def is_bgzf(path: str) -> bool:
+    """Check the first bytes of the file to see if it is gzip/BGZF compressed"""
+    with open(path, 'rb') as file:
+        return file.read(2) == b'\x1f\x8b'
+
+def reg2bin(beg, end):
+    """Calculate the BAM bin for a read that covers beg to end (0 based, end is exclusive). This is taken from the SAM spec."""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+################################################### BGZF Section
+
+def read_raw_bgzf_blocks(file):
+    """Go through the BGZF file and hand back the compressed data, crc, and uncompressed size for every block"""
+    while True:
+        header = file.read(12)
+
+        # We are at the end of the file
+        if not header:
+            return
+
+        id1, id2, method, flags, mtime, extra_flags, os_flag, extra_length = struct.unpack('<BBBBIBBH', header)
+        if id1 != 31 or id2 != 139 or not flags & 4:
+            raise ValueError('This file is not BGZF compressed. Please compress it with bgzip or samtools.')
+
+        # Look through the extra fields for the BC field which holds the size of the block
+        extra = file.read(extra_length)
+        block_size = None
+        position = 0
+        while position < extra_length:
+            field_id, field_length = extra[position:position + 2], struct.unpack_from('<H', extra, position + 2)[0]
+            if field_id == b'BC':
+                block_size = struct.unpack_from('<H', extra, position + 4)[0]
+            position += 4 + field_length
+
+        if block_size == None:
+            raise ValueError('This file is gzip compressed but not with BGZF. Please compress it with bgzip or samtools.')
+
+        # The block size does not count itself and includes the 12 bytes of header, the extra fields, and the 8 byte footer
+        compressed_data = file.read(block_size - extra_length - 19)
+        crc, uncompressed_size = struct.unpack('<II', file.read(8))
+
+        yield compressed_data, crc, uncompressed_size
+
+def decompress_block(compressed_data, crc, uncompressed_size):
+    """Inflate a single BGZF block and make sure it came out how it went in"""
+    data = zlib.decompress(compressed_data, -15)
+
+    if len(data) != uncompressed_size or zlib.crc32(data) != crc:
+        raise ValueError('A BGZF block is corrupted, the crc or size does not match.')
+
+    return data
+
+def compress_block(data, level):
+    """Deflate a single chunk of data into a full BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+
+    # Build the gzip header with the BC extra field that holds the total block size minus 1
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed_data) + 25)
+    footer = struct.pack('<II', zlib.crc32(data), len(data))
+
+    return header + compressed_data + footer
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    File like object that reads a BGZF file. The blocks are decompressed by a pool of threads ahead of where the file is
+    being read from, and they are handed out in the same order as the file.
+    """
+
+    def __init__(self, path_or_file, threads=4):
+        # This can be given a path or a file that is already open in binary mode (like stdin)
+        if isinstance(path_or_file, str):
+            self.file = open(path_or_file, 'rb')
+        else:
+            self.file = path_or_file
+        self.name = getattr(self.file, 'name', None)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.raw_blocks = read_raw_bgzf_blocks(self.file)
+
+        # Keep a few blocks in flight for every thread so that they always have work, but don't run off with all the memory
+        self.max_pending = threads * 4
+        self.pending = collections.deque()
+
+        # The block that is currently being read from
+        self.block = b''
+        self.block_position = 0
+
+    def readable(self):
+        return True
+
+    def next_block(self):
+        """Fill the queue of blocks being decompressed and then return the next block in order"""
+        while len(self.pending) < self.max_pending:
+            raw_block = next(self.raw_blocks, None)
+            if raw_block == None:
+                break
+            self.pending.append(self.pool.submit(decompress_block, *raw_block))
+
+        # There are no more blocks left
+        if not self.pending:
+            return None
+
+        return self.pending.popleft().result()
+
+    def readinto(self, buffer):
+        # Move on to the next block if this one has been used up. Empty blocks (like the EOF block) are skipped.
+        while self.block_position >= len(self.block):
+            block = self.next_block()
+            if block == None:
+                return 0
+            self.block = block
+            self.block_position = 0
+
+        # Copy as much of the block as will fit
+        size = min(len(buffer), len(self.block) - self.block_position)
+        buffer[:size] = self.block[self.block_position:self.block_position + size]
+        self.block_position += size
+
+        return size
+
+    def close(self):
+        if not self.closed:
+            for pending_block in self.pending:
+                pending_block.cancel()
+            self.pool.shutdown()
+            self.file.close()
+        super().close()
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    File like object that writes a BGZF file. The data is cut up into blocks which are compressed by a pool of threads and
+    written to the file in order.
+    """
+
+    def __init__(self, path_or_file, threads=4, level=6):
+        # This can be given a path or a file that is already open in binary mode (like stdout)
+        if isinstance(path_or_file, str):
+            self.file = open(path_or_file, 'wb')
+        else:
+            self.file = path_or_file
+        self.name = getattr(self.file, 'name', None)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.level = level
+
+        # Keep a few blocks in flight for every thread so that they always have work, but don't run off with all the memory
+        self.max_pending = threads * 4
+        self.pending = collections.deque()
+
+        # The data that has not been made into a block yet
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write_finished_blocks(self, wait):
+        """Write out the compressed blocks at the front of the queue. If wait is set then wait for everything to be written."""
+        while self.pending and (wait or len(self.pending) >= self.max_pending or self.pending[0].done()):
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+
+        # Send off every full block to be compressed
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.pending.append(self.pool.submit(compress_block, bytes(self.buffer[:BGZF_BLOCK_SIZE]), self.level))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+            self.write_finished_blocks(wait=False)
+
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            # Compress what is left and finish the file with the EOF block
+            if self.buffer:
+                self.pending.append(self.pool.submit(compress_block, bytes(self.buffer), self.level))
+                self.buffer.clear()
+            self.write_finished_blocks(wait=True)
+            self.file.write(BGZF_EOF)
+            self.pool.shutdown()
+            self.file.close()
+        super().close()
+
+################################################### BAM Section
+
+def decode_tags(data, position):
+    """Turn the binary tags at the end of a BAM record into the SAM text version of them"""
+    tags = list()
+
+    while position < len(data):
+        tag, tag_type = data[position:position + 2].decode(), chr(data[position + 2])
+        position += 3
+
+        # Single characters
+        if tag_type == 'A':
+            tags.append(f'{tag}:A:{chr(data[position])}')
+            position += 1
+
+        # All of the integer types are written as i in SAM
+        elif tag_type in 'cCsSiI':
+            tag_format = TAG_FORMATS[tag_type]
+            tags.append(f'{tag}:i:{struct.unpack_from(tag_format, data, position)[0]}')
+            position += struct.calcsize(tag_format)
+
+        elif tag_type == 'f':
+            tags.append(f'{tag}:f:{struct.unpack_from("<f", data, position)[0]:g}')
+            position += 4
+
+        # Strings and hex strings end with a NUL
+        elif tag_type in 'ZH':
+            end = data.index(b'\x00', position)
+            tags.append(f'{tag}:{tag_type}:{data[position:end].decode()}')
+            position = end + 1
+
+        # Arrays have a type and count and then the values
+        elif tag_type == 'B':
+            array_type = chr(data[position])
+            count = struct.unpack_from('<i', data, position + 1)[0]
+            tag_format = '<' + TAG_FORMATS[array_type][1] * count
+            values = struct.unpack_from(tag_format, data, position + 5)
+            if array_type == 'f':
+                tags.append(f'{tag}:B:{array_type},' + ','.join(f'{value:g}' for value in values))
+            else:
+                tags.append(f'{tag}:B:{array_type},' + ','.join(str(value) for value in values))
+            position += 5 + struct.calcsize(tag_format)
+
+        else:
+            raise ValueError(f'Unknown tag type {tag_type} in the BAM file.')
+
+    return tags
+
+def encode_tag(tag_field: str) -> bytes:
+    """Turn a SAM text tag (TG:TYPE:VALUE) into its binary BAM version"""
+    tag, tag_type, value = tag_field.split(':', 2)
+
+    if tag_type == 'A':
+        return tag.encode() + b'A' + value.encode()
+
+    # Use the smallest integer type that fits the value, which is what samtools does
+    if tag_type == 'i':
+        value = int(value)
+        if value < 0:
+            for int_type in 'csi':
+                if value >= -(1 << (struct.calcsize(TAG_FORMATS[int_type]) * 8 - 1)):
+                    break
+        else:
+            for int_type in 'CSI':
+                if value < 1 << (struct.calcsize(TAG_FORMATS[int_type]) * 8):
+                    break
+        return tag.encode() + int_type.encode() + struct.pack(TAG_FORMATS[int_type], value)
+
+    if tag_type == 'f':
+        return tag.encode() + b'f' + struct.pack('<f', float(value))
+
+    if tag_type in 'ZH':
+        return tag.encode() + tag_type.encode() + value.encode() + b'\x00'
+
+    if tag_type == 'B':
+        array_type, *values = value.split(',')
+        if array_type == 'f':
+            values = [float(number) for number in values]
+        else:
+            values = [int(number) for number in values]
+        return tag.encode() + b'B' + array_type.encode() + struct.pack('<i', len(values)) + \
+            struct.pack('<' + TAG_FORMATS[array_type][1] * len(values), *values)
+
+    raise ValueError(f'Unknown tag type {tag_type} in the SAM line.')
+
+def get_references(header_lines) -> list:
+    """Pull the (name, length) of every reference out of the @SQ header lines"""
+    references = list()
+
+    for header_line in header_lines:
+        if header_line.startswith('@SQ'):
+            fields = dict(field.split(':', 1) for field in header_line.strip('\n').split('\t')[1:] if ':' in field)
+            references.append((fields['SN'], int(fields['LN'])))
+
+    return references
+
+
+class BamReader:
+    """
+    Reads a BAM file and hands back SAM lines. The header lines come first, followed by one line for every read, so this can
+    be used anywhere an open SAM file would be iterated over. It is given the decompressed stream from open_bgzf_stream.
+    """
+
+    def __init__(self, bgzf_file):
+        self.file = bgzf_file
+        self.name = bgzf_file.name
+
+        # Check that this is a BAM and not just compressed text
+        if self.file.read(4) != b'BAM\x01':
+            raise ValueError(f'{self.name} is BGZF compressed but is not a BAM file.')
+
+        # Read in the header text and the list of references
+        text_length = struct.unpack('<i', self.file.read(4))[0]
+        self.header_text = self.file.read(text_length).decode().rstrip('\x00')
+        self.references = list()
+        for _ in range(struct.unpack('<i', self.file.read(4))[0]):
+            name_length = struct.unpack('<i', self.file.read(4))[0]
+            name = self.file.read(name_length).rstrip(b'\x00').decode()
+            self.references.append((name, struct.unpack('<i', self.file.read(4))[0]))
+
+        # Some BAM files only have the references in binary so make @SQ lines for them
+        self.header_lines = self.header_text.splitlines(keepends=True)
+        if self.header_lines and not self.header_lines[-1].endswith('\n'):
+            self.header_lines[-1] += '\n'
+        if not any(header_line.startswith('@SQ') for header_line in self.header_lines):
+            self.header_lines += [f'@SQ\tSN:{name}\tLN:{length}\n' for name, length in self.references]
+
+    def __iter__(self):
+        yield from self.header_lines
+
+        while True:
+            block_size = self.file.read(4)
+
+            # We are at the end of the file
+            if not block_size:
+                return
+
+            yield self.record_to_sam(self.file.read(struct.unpack('<i', block_size)[0]))
+
+    def record_to_sam(self, data) -> str:
+        """Turn a single binary BAM record into a SAM line"""
+        ref_id, pos, name_length, mapq, bam_bin, n_cigar, flag, seq_length, next_ref_id, next_pos, tlen = \
+            struct.unpack_from('<iiBBHHHiiii', data)
+        position = 32
+
+        # The name ends with a NUL
+        qname = data[position:position + name_length - 1].decode()
+        position += name_length
+
+        # Each CIGAR op is the length shifted over 4 with the op in the last 4 bits
+        cigar_values = struct.unpack_from(f'<{n_cigar}I', data, position)
+        cigar = ''.join(f'{value >> 4}{CIGAR_OPS[value & 15]}' for value in cigar_values) or '*'
+        position += n_cigar * 4
+
+        # Each byte of the sequence has 2 bases in it
+        seq_bytes = (seq_length + 1) // 2
+        seq = ''.join([SEQ_DECODE[byte] for byte in data[position:position + seq_bytes]])[:seq_length] or '*'
+        position += seq_bytes
+
+        # A quality of 0xff means that there are no qualities
+        qual = data[position:position + seq_length]
+        if not qual or qual[0] == 0xff:
+            qual = '*'
+        else:
+            qual = qual.translate(QUAL_DECODE).decode()
+        position += seq_length
+
+        # Find the reference names
+        rname = self.references[ref_id][0] if ref_id >= 0 else '*'
+        if next_ref_id < 0:
+            rnext = '*'
+        elif next_ref_id == ref_id:
+            rnext = '='
+        else:
+            rnext = self.references[next_ref_id][0]
+
+        fields = [qname, str(flag), rname, str(pos + 1), str(mapq), cigar, rnext, str(next_pos + 1), str(tlen), seq, qual]
+        fields += decode_tags(data, position)
+
+        return '\t'.join(fields) + '\n'
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BamWriter:
+    """
+    File like object that takes SAM text and writes it out as a BAM file. The header lines are held until the first read shows
+    up (or the file is closed), since the references in the @SQ lines are needed before any read can be written.
+    """
+
+    def __init__(self, path_or_file, threads=4, level=6):
+        self.file = io.BufferedWriter(BgzfWriter(path_or_file, threads, level), buffer_size=BGZF_BLOCK_SIZE * 4)
+        self.name = self.file.name
+        self.header_lines = list()
+        self.reference_ids = None
+
+        # Text can come in pieces that don't line up with the lines (like from shutil.copyfileobj)
+        self.partial_line = ''
+
+    def write_header(self):
+        """Write the BAM header from the header lines that have been collected"""
+        references = get_references(self.header_lines)
+        self.reference_ids = {name: index for index, (name, length) in enumerate(references)}
+
+        header_text = ''.join(self.header_lines).encode()
+        header = b'BAM\x01' + struct.pack('<i', len(header_text)) + header_text + struct.pack('<i', len(references))
+        for name, length in references:
+            header += struct.pack('<i', len(name) + 1) + name.encode() + b'\x00' + struct.pack('<i', length)
+
+        self.file.write(header)
+
+    def sam_to_record(self, sam_line: str) -> bytes:
+        """Turn a single SAM line into a binary BAM record"""
+        fields = sam_line.rstrip('\n').split('\t')
+        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual = fields[:11]
+
+        # Find the reference ids
+        ref_id = self.reference_ids[rname] if rname != '*' else -1
+        if rnext == '=':
+            next_ref_id = ref_id
+        elif rnext == '*':
+            next_ref_id = -1
+        else:
+            next_ref_id = self.reference_ids[rnext]
+
+        # Pack the CIGAR and find how much of the reference it covers for the bin
+        cigar_values = list()
+        reference_length = 0
+        if cigar != '*':
+            number = 0
+            for character in cigar:
+                if character.isdigit():
+                    number = number * 10 + int(character)
+                else:
+                    cigar_values.append(number << 4 | CIGAR_OPS.index(character))
+                    if character in 'MDN=X':
+                        reference_length += number
+                    number = 0
+
+        # Pack the sequence 2 bases to a byte
+        if seq == '*':
+            seq = ''
+        seq_codes = [SEQ_ENCODE[base] for base in seq.upper()] + [0]
+        packed_seq = bytes(seq_codes[index] << 4 | seq_codes[index + 1] for index in range(0, len(seq), 2))
+
+        # Missing qualities are written as 0xff
+        if qual == '*':
+            packed_qual = b'\xff' * len(seq)
+        else:
+            packed_qual = qual.encode().translate(QUAL_ENCODE)
+
+        beg = int(pos) - 1
+        bam_bin = reg2bin(beg, beg + max(reference_length, 1))
+        record = struct.pack('<iiBBHHHiiii', ref_id, beg, len(qname) + 1, int(mapq), bam_bin, len(cigar_values), int(flag),
+            len(seq), next_ref_id, int(pnext) - 1, int(tlen))
+        record += qname.encode() + b'\x00' + struct.pack(f'<{len(cigar_values)}I', *cigar_values) + packed_seq + packed_qual
+        record += b''.join(encode_tag(tag_field) for tag_field in fields[11:])
+
+        return struct.pack('<i', len(record)) + record
+
+    def write_line(self, sam_line: str):
+        """Write out a single full SAM line"""
+        if sam_line.startswith('@') and self.reference_ids == None:
+            self.header_lines.append(sam_line)
+        else:
+            if self.reference_ids == None:
+                self.write_header()
+            self.file.write(self.sam_to_record(sam_line))
+
+    def write(self, text: str):
+        lines = (self.partial_line + text).split('\n')
+
+        # The last piece is either empty or a line that hasn't finished yet
+        self.partial_line = lines.pop()
+        for sam_line in lines:
+            self.write_line(sam_line + '\n')
+
+        return len(text)
+
+    def close(self):
+        if self.partial_line:
+            self.write_line(self.partial_line + '\n')
+            self.partial_line = ''
+        if self.reference_ids == None:
+            self.write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+################################################### Opening Section
+
+def open_bgzf_stream(path_or_file, threads=4):
+    """Open a BGZF file (from a path or a binary file) as a buffered stream of the decompressed data"""
+    return io.BufferedReader(BgzfReader(path_or_file, threads), buffer_size=BGZF_BLOCK_SIZE * 4)
+
+def open_sam_input(path: str, threads=4):
+    """
+    Open a SAM file for reading. BAM files and BGZF compressed SAM files are found by looking at the first bytes of the file,
+    and anything else is opened as plain text. If the path is - then stdin is read. Everything that is returned can be iterated
+    over to get SAM lines.
+    """
+    if path == '-':
+        raw_file = open(sys.stdin.fileno(), 'rb', buffering=STREAM_BUFFER_SIZE, closefd=False)
+    else:
+        raw_file = open(path, 'rb', buffering=STREAM_BUFFER_SIZE)
+
+    # Peek at the start of the file so that nothing is used up, since stdin can't go back
+    if raw_file.peek(2)[:2] != b'\x1f\x8b':
+        return io.TextIOWrapper(raw_file)
+
+    # Check if the decompressed data starts like a BAM file
+    bgzf_file = open_bgzf_stream(raw_file, threads)
+    if bgzf_file.peek(4)[:4] == b'BAM\x01':
+        return BamReader(bgzf_file)
+    else:
+        return io.TextIOWrapper(bgzf_file)
+
+def open_sam_output(path: str, output_format='sam', threads=4, resume_length=None):
+    """
+    Open a file to write SAM lines to. The format can be sam, bam, or bgzf (which is BGZF compressed SAM text). If the path
+    is - then everything is written to stdout. If resume_length is given then the file is kept, cut back to that many bytes,
+    and written to from there, which only works for plain SAM.
+    """
+    if path == '-':
+        raw_file = open(sys.stdout.fileno(), 'wb', buffering=STREAM_BUFFER_SIZE, closefd=False)
+    elif resume_length != None:
+        raw_file = open(path, 'r+b', buffering=STREAM_BUFFER_SIZE)
+        raw_file.truncate(resume_length)
+        raw_file.seek(resume_length)
+    else:
+        raw_file = open(path, 'wb', buffering=STREAM_BUFFER_SIZE)
+
+    if output_format == 'bam':
+        return BamWriter(raw_file, threads)
+    elif output_format == 'bgzf':
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(raw_file, threads), buffer_size=BGZF_BLOCK_SIZE * 4))
+    else:
+        return io.TextIOWrapper(raw_file)
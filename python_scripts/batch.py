@@ -0,0 +1,76 @@
+"""
+Helpers for running many SAM files in one go with -m. The manifest is a tab separated file with one SAM file per line,
+optionally followed by the output path and the name of the duplicate file (the same as -o and -do for a single file).
+Blank lines and lines starting with # are skipped. Every file is deduped in a worker of one shared process pool, so the
+UMI file is only loaded once and NumPy is only imported once per worker instead of once per file.
+"""
+
+import copy
+import re
+
+
+# Columns of the per file summary
+SUMMARY_COLUMNS = ('input', 'output', 'kept_reads', 'duplicate_reads', 'seconds', 'status')
+
+
+def read_manifest(manifest_path: str):
+    """Read the manifest into a list of (input, output or None, duplicate name or None)"""
+    entries = list()
+    with open(manifest_path) as manifest_file:
+        for manifest_line in manifest_file:
+            manifest_line = manifest_line.rstrip('\n')
+            if not manifest_line.strip() or manifest_line.startswith('#'):
+                continue
+            columns = [column.strip() for column in manifest_line.split('\t')]
+            if len(columns) > 3:
+                raise ValueError(f'Manifest lines can only have the input, output and duplicate name columns: {manifest_line}')
+            columns += [None] * (3 - len(columns))
+            entries.append(tuple(column if column else None for column in columns))
+
+    if not entries:
+        raise ValueError(f'There are no SAM files in the manifest {manifest_path}')
+    return entries
+
+def get_file_args(batch_args, entry):
+    """
+    Make the arguments for one file of the manifest. Each file is run on its own with one thread, and if duplicates are
+    being stored without a name in the manifest they are named after the input file.
+    """
+    input_path, output_path, duplicate_output = entry
+    file_args = copy.copy(batch_args)
+    file_args.manifest = None
+    file_args.threads = 1
+    file_args.file = input_path
+    file_args.output = output_path
+    if file_args.store_duplicates == True:
+        if duplicate_output == None:
+            duplicate_output = re.sub(r'\.sam\.gz$|\.sam$|\.bam$', '', input_path).split('/')[-1] + '_duplicates'
+        file_args.duplicate_output = duplicate_output
+    return file_args
+
+
+class CountingWriter:
+    """Wraps an output file and counts the reads written to it, leaving out the header lines"""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.name = output_file.name
+        self.reads = 0
+
+    def write(self, text):
+        if not text.startswith('@'):
+            self.reads += text.count('\n')
+        return self.output_file.write(text)
+
+    def flush(self):
+        self.output_file.flush()
+
+    def close(self):
+        self.output_file.close()
+
+
+def print_summary(summaries, summary_file):
+    """Write the per file summary as a tab separated table"""
+    print(*SUMMARY_COLUMNS, sep='\t', file=summary_file)
+    for summary in summaries:
+        print(*[summary[column] for column in SUMMARY_COLUMNS], sep='\t', file=summary_file)
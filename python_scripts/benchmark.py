@@ -0,0 +1,141 @@
+"""
+Benchmark the deduper on synthetic SAM files from generate_sam.py. Each engine is run in every mode (-q, -ds, known and
+random UMIs) and the reads per second and peak memory (max RSS) of each run are reported. The output of every run is
+checked against the default dict engine run of powers_deduper.py in the same mode, so a faster engine that gives different
+output shows up right away.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# The scripts this runs live next to this one
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEDUPER = os.path.join(SCRIPT_DIR, 'powers_deduper.py')
+GENERATOR = os.path.join(SCRIPT_DIR, 'generate_sam.py')
+DEFAULT_UMI_FILE = os.path.join(SCRIPT_DIR, '..', 'STL96.txt')
+
+# The modes every engine is run in
+MODES = {
+    'default': [],
+    'quality': ['-q', 'True'],
+    'duplicates': ['-ds', 'True', '-do', 'benchmark'],
+    'quality+duplicates': ['-q', 'True', '-ds', 'True', '-do', 'benchmark'],
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark every engine and mode of powers_deduper.py on synthetic SAM files')
+    parser.add_argument('-n', '--reads', help='Number of reads in each synthetic file. Default=200000', default=200000, type=int)
+    parser.add_argument('-c', '--chromosomes', help='Number of chromosomes in each synthetic file. Default=3', default=3, type=int)
+    parser.add_argument('-dr', '--duplicate_rate', help='Fraction of reads that are duplicates. Default=0.3', default=0.3, type=float)
+    parser.add_argument('-sc', '--softclip_rate', help='Fraction of reads that have soft clipping on each end. Default=0.2', \
+        default=0.2, type=float)
+    parser.add_argument('-rs', '--reverse_rate', help='Fraction of reads on the reverse strand. Default=0.5', default=0.5, type=float)
+    parser.add_argument('-s', '--seed', help='Seed for the synthetic files. Default=1', default=1, type=int)
+    parser.add_argument('-u', '--umi', help='UMI file used for the known UMI runs. Default=STL96.txt', default=DEFAULT_UMI_FILE, type=str)
+    parser.add_argument('-e', '--engines', help='Comma separated engines to run. Default=dict,numpy,mmap', default='dict,numpy,mmap', \
+        type=str)
+    parser.add_argument('-x', '--extra', help='Extra arguments passed to every run, for example "-t 4". Default=none', default='', type=str)
+    parser.add_argument('-k', '--keep', help='Folder to keep the synthetic files and outputs in. By default they go in a temporary \
+        folder that is removed at the end', default=None, type=str)
+    return parser.parse_args()
+
+def generate(args, umi_source: str, sam_path: str):
+    """Make the synthetic SAM file for one UMI source"""
+    subprocess.run([sys.executable, GENERATOR, '-n', str(args.reads), '-c', str(args.chromosomes), '-dr', str(args.duplicate_rate),
+        '-sc', str(args.softclip_rate), '-rs', str(args.reverse_rate), '-u', umi_source, '-s', str(args.seed), '-o', sam_path],
+        check=True)
+
+def run_deduper(run_dir: str, deduper_args):
+    """
+    Run powers_deduper.py in run_dir and return the seconds it took and its peak RSS in MB. wait4 gives the resource usage of
+    just this child, so one run never shows up in the memory of another.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, DEDUPER] + deduper_args, cwd=run_dir, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise RuntimeError(f'powers_deduper.py {" ".join(deduper_args)} failed:\n{stderr.decode()}')
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+    return seconds, peak_mb
+
+def read_output(path: str):
+    """Read an output file, or None if the run didn't make one"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as output_file:
+        return output_file.readlines()
+
+def compare_outputs(baseline, outputs) -> str:
+    """Compare the outputs of a run against the baseline run"""
+    if outputs == baseline:
+        return 'same'
+    if all(output != None and sorted(output) == sorted(base) for output, base in zip(outputs, baseline) if base != None):
+        return 'same reads, other order'
+    return 'DIFFERENT'
+
+def run_in_dir(work_dir: str, run_name: str, deduper_args):
+    """Run the deduper in its own folder, returning the seconds, the peak MB, and the output and duplicate lines"""
+    run_dir = os.path.join(work_dir, run_name)
+    os.makedirs(os.path.join(run_dir, 'output', 'duplicates'), exist_ok=True)
+    output_path = os.path.join(run_dir, 'deduped.sam')
+    duplicate_path = os.path.join(run_dir, 'output', 'duplicates', 'benchmark.sam')
+
+    seconds, peak_mb = run_deduper(run_dir, deduper_args + ['-o', output_path])
+    return seconds, peak_mb, [read_output(output_path), read_output(duplicate_path)]
+
+def run_benchmarks(args, work_dir: str):
+    """Run every UMI source, mode and engine, printing one line for each run"""
+    engines = [engine for engine in args.engines.split(',') if engine]
+    extra = args.extra.split()
+
+    print('umis', 'mode', 'engine', 'seconds', 'reads/s', 'peak MB', 'parity', sep='\t')
+    for umi_name, umi_source in (('known', args.umi), ('random', 'random')):
+        sam_path = os.path.join(work_dir, f'synthetic_{umi_name}.sam')
+        generate(args, umi_source, sam_path)
+
+        for mode_name, mode_args in MODES.items():
+            # The baseline is the default dict engine in the same mode, without the extra arguments
+            baseline_args = ['-f', sam_path, '-u', umi_source] + mode_args
+            baseline_seconds, baseline_mb, baseline = run_in_dir(work_dir, f'{umi_name}_{mode_name}_baseline', baseline_args)
+
+            for engine in engines:
+                # Without extra arguments the dict engine run is the baseline run
+                if engine == 'dict' and not extra:
+                    seconds, peak_mb, parity = baseline_seconds, baseline_mb, 'baseline'
+                else:
+                    seconds, peak_mb, outputs = run_in_dir(work_dir, f'{umi_name}_{mode_name}_{engine}',
+                        baseline_args + ['-e', engine] + extra)
+                    parity = compare_outputs(baseline, outputs)
+
+                print(umi_name, mode_name, ' '.join([engine] + extra), f'{seconds:.2f}', f'{args.reads / seconds:.0f}',
+                    f'{peak_mb:.1f}', parity, sep='\t')
+
+########################################## Script Logic
+
+if __name__ == '__main__':
+
+    args = get_args()
+
+    if args.keep != None:
+        os.makedirs(args.keep, exist_ok=True)
+        run_benchmarks(args, os.path.abspath(args.keep))
+    else:
+        work_dir = tempfile.mkdtemp(prefix='deduper_benchmark_')
+        try:
+            run_benchmarks(args, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
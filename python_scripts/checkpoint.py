@@ -0,0 +1,42 @@
+"""
+Checkpoints for long running jobs. Every time the chromosome changes the dictionary is empty and everything before it has
+been written out, so a small JSON file is written that records where the next chromosome starts in the input, how long the
+output files were at that point, and the stats so far. A job that is stopped part of the way through can then be started
+again with --resume: the output files are cut back to the recorded lengths, the input is read from the recorded offset,
+and at most one chromosome of work is lost.
+"""
+
+import json
+import os
+
+
+def write_checkpoint(checkpoint_path: str, state: dict):
+    """
+    Write the checkpoint to a temporary file first and then move it into place, so a job killed part way through the write
+    never leaves a broken checkpoint behind.
+    """
+    temporary_path = checkpoint_path + '.tmp'
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, checkpoint_path)
+
+def read_checkpoint(checkpoint_path: str):
+    """Read the checkpoint back in, or return None if there isn't one yet"""
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def remove_checkpoint(checkpoint_path: str):
+    """Remove the checkpoint once the run has finished, so the next run with --resume starts from the beginning"""
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+def file_length(output_file) -> int:
+    """Flush an output file all the way to disk and return how many bytes are in it"""
+    output_file.flush()
+    with open(output_file.name, 'rb') as flushed_file:
+        os.fsync(flushed_file.fileno())
+    return os.path.getsize(output_file.name)
@@ -0,0 +1,61 @@
+"""
+Works out how far the 5' end of a read is from its POS using the CIGAR string. Every CIGAR string is only parsed once and
+the offsets are kept in an LRU cache, since a few hundred different CIGAR strings make up almost every read in a SAM file.
+"""
+
+import functools
+import re
+
+
+# Each CIGAR element is a length followed by one of the operations
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# The operations that move along the reference
+REFERENCE_OPS = set('MDN=X')
+
+# The most CIGAR strings that will be held in the cache
+CIGAR_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def five_prime_offsets(cigar) -> tuple:
+    """
+    Parse the CIGAR string and return (forward offset, reverse offset). These get added onto POS to get the 5' position of
+    the read.
+
+    For the forward strand the 5' end is the leftmost base, so the offset takes off the soft clipping at the start of the read.
+    For the reverse strand the 5' end is on the right, so the offset adds on every operation that moves along the reference
+    (M, D, N, = and X) plus the soft clipping at the end of the read. Insertions, hard clipping and padding don't take up
+    any reference so they are skipped.
+
+    The CIGAR can also be given as bytes, in which case it is only decoded the first time it is seen.
+    """
+    if isinstance(cigar, bytes):
+        cigar = cigar.decode()
+
+    # Unmapped reads don't have a CIGAR string
+    if cigar == '*':
+        return 0, 0
+
+    elements = CIGAR_PATTERN.findall(cigar)
+
+    # Make sure that the whole string was made up of CIGAR elements
+    if not elements or sum(len(length) + 1 for length, op in elements) != len(cigar):
+        raise ValueError(f'{cigar} is not a valid CIGAR string')
+
+    # Hard clipping sits outside of the soft clipping, so step past it to find the soft clipping on each end
+    first, last = 0, len(elements) - 1
+    if elements[first][1] == 'H':
+        first += 1
+    if elements[last][1] == 'H' and last > first:
+        last -= 1
+
+    forward_offset = 0
+    if elements[first][1] == 'S':
+        forward_offset = -int(elements[first][0])
+
+    reverse_offset = sum(int(length) for length, op in elements if op in REFERENCE_OPS)
+    if elements[last][1] == 'S' and last != first:
+        reverse_offset += int(elements[last][0])
+
+    return forward_offset, reverse_offset
@@ -0,0 +1,205 @@
+"""
+Importable version of the deduper that doesn't go through the command line arguments. A Deduper takes its options when it
+is made, loads the UMIs once, and can then dedup any number of samples in the same process:
+
+    import deduper_api
+
+    deduper = deduper_api.Deduper(umi='STL96.txt', quality=True, store_duplicates=True)
+    with open('sample.sam') as sam_file:
+        for kind, sam_line in deduper.dedup(sam_file):
+            ...
+
+dedup takes an iterable of SAM lines (str) or raw chunks of a SAM file (bytes, split into lines here) and yields
+('header', line), ('kept', line) and ('duplicate', line) tuples. The reads still have to be sorted. The work is done by the
+same engines as powers_deduper.py, so the kept reads come out in the same order as they are written by the script. NumPy is
+only imported the first time the numpy engine is used, and nothing is printed unless the Deduper is made with verbose.
+"""
+
+import dict_engine
+import paired_engine
+import umi_keys
+
+
+class UmiIds(dict):
+    """
+    The known UMIs mapped to their ids, which also remembers if the UMIs are random. Random UMIs have no known UMIs, so
+    the empty dictionary alone can't tell them apart from a UMI file with nothing in it.
+    """
+
+    def __init__(self, umi_ids=(), random_umis=False):
+        super().__init__(umi_ids)
+        self.random_umis = random_umis
+
+
+def load_umis(umi='random', error_correct=0) -> UmiIds:
+    """
+    Load the known UMIs and give each one a small id for the packed keys. umi can be 'random', the path to a UMI file
+    separated by newlines, or any iterable of UMIs. With error_correct every UMI within that Hamming distance of exactly one
+    known UMI is added under the id of that known UMI. UMIs that were already loaded are handed back as they are, so they
+    can be shared between Dedupers, and any other dictionary is taken as known UMIs that already have their ids.
+    """
+    if isinstance(umi, UmiIds):
+        return umi
+    if isinstance(umi, dict):
+        return UmiIds(umi)
+
+    if isinstance(umi, str):
+        umi_ids = umi_keys.number_umis(dict_engine.instantiate_umi_set(umi))
+    else:
+        umi_ids = umi_keys.number_umis({known_umi.strip() for known_umi in umi})
+
+    if error_correct > 0:
+        umi_ids = umi_keys.add_umi_neighbors(umi_ids, error_correct)
+    return UmiIds(umi_ids, random_umis=isinstance(umi, str) and umi == 'random')
+
+
+class LineCollector:
+    """Stands in for an output file. The engines write to it and everything written is handed back one line at a time."""
+
+    def __init__(self):
+        self.texts = list()
+
+    def write(self, text):
+        self.texts.append(text)
+
+    def drain(self):
+        """Yield the lines written since the last drain"""
+        texts = self.texts
+        self.texts = list()
+        yield from texts
+
+
+def split_lines(records):
+    """
+    Turn the records into SAM lines that end with a newline. str records are whole lines. bytes records are chunks of the
+    file that can end part of the way through a line, so the end of each chunk is held back until the rest of the line comes.
+    """
+    partial_line = b''
+    for record in records:
+        if isinstance(record, str):
+            yield record if record.endswith('\n') else record + '\n'
+            continue
+
+        chunk_lines = (partial_line + bytes(record)).split(b'\n')
+        partial_line = chunk_lines.pop()
+        for chunk_line in chunk_lines:
+            yield chunk_line.decode() + '\n'
+
+    # The file didn't end with a newline
+    if partial_line:
+        yield partial_line.decode() + '\n'
+
+
+class Deduper:
+    """
+    Dedups sorted SAM reads with the options it is made with. These work the same as the flags of powers_deduper.py:
+
+    umi              'random' (-u left out), a UMI file, an iterable of UMIs, or the UMIs from load_umis (-u)
+    quality          keep the best quality read instead of the first one (-q)
+    store_duplicates hand back the duplicates as well as the kept reads (-ds)
+    paired           dedup paired reads on both mates (-p)
+    engine           'dict' or 'numpy' (-e)
+    window           largest soft clip, so reads far enough behind are handed back early (-w)
+    streaming        hand back each read as soon as it is first seen (-st)
+    error_correct    Hamming distance to correct UMIs to the known UMIs (-ec)
+    directional      cluster random UMIs one mismatch apart (-dc), with directional_ratio (-dr)
+    chunk_size       number of reads the numpy engine works on at a time (-cs)
+    max_memory       megabytes of reads the dictionary holds before it is spilled to disk in spill_dir (-mm)
+    verbose          print every new chromosome to stderr like the script does
+    """
+
+    def __init__(self, umi='random', quality=False, store_duplicates=False, paired=False, engine='dict', window=None,
+        streaming=False, error_correct=0, directional=False, directional_ratio=2.0, chunk_size=10000,
+        max_memory=None, spill_dir=None, verbose=False):
+        # Random UMIs are worked out from the loaded UMIs, so the UMIs from load_umis('random') are random too
+        umi_ids = load_umis(umi, error_correct)
+        random_umis = umi_ids.random_umis
+
+        # The same checks as the script makes on its arguments
+        if engine not in ('dict', 'numpy'):
+            raise ValueError(f'Unknown engine {engine}. Please use dict or numpy')
+        if paired == True and (engine != 'dict' or window != None or streaming == True or directional == True):
+            raise ValueError('paired only works with the dict engine and without window, streaming or directional')
+        if window != None and (window < 0 or engine != 'dict'):
+            raise ValueError('window has to be 0 or greater and only works with the dict engine')
+        if streaming == True and (quality == True or engine != 'dict'):
+            raise ValueError('streaming always keeps the first read so it can not be used with quality, and only works with the dict engine')
+        if error_correct < 0 or (error_correct > 0 and random_umis):
+            raise ValueError('error_correct has to be 0 or greater and needs known UMIs')
+        if directional == True and (not random_umis or engine != 'dict' or window != None or streaming == True):
+            raise ValueError('directional only works with random UMIs on the dict engine, and without window or streaming')
+        if chunk_size < 1:
+            raise ValueError('chunk_size has to be at least 1')
+        if max_memory != None and (max_memory <= 0 or engine != 'dict' or paired == True or window != None or streaming == True
+            or directional == True):
+            raise ValueError('max_memory has to be more than 0 and only works with the dict engine on single end reads, without \
+window, streaming or directional')
+
+        self.umi_ids = umi_ids
+        self.random_umis = random_umis
+        self.quality = quality == True
+        self.store_duplicates = store_duplicates == True
+        self.paired = paired == True
+        self.engine = engine
+        self.window = window
+        self.streaming = streaming == True
+        self.directional_ratio = directional_ratio if directional == True else None
+        self.chunk_size = chunk_size
+        self.max_memory = int(max_memory * (1 << 20)) if max_memory != None else None
+        self.spill_dir = spill_dir
+        self.verbose = verbose == True
+
+    def make_engine(self, output_file, duplicate_file):
+        """Make a new engine for one sample"""
+        if self.engine == 'numpy':
+            import numpy_engine
+            return numpy_engine.NumpyDedupEngine(self.umi_ids, self.random_umis, self.quality, output_file, duplicate_file,
+                verbose=self.verbose)
+        if self.paired == True:
+            return paired_engine.PairedDedupEngine(self.umi_ids, self.random_umis, self.quality, output_file, duplicate_file,
+                verbose=self.verbose)
+        return dict_engine.DictDedupEngine(self.umi_ids, self.random_umis, self.quality, output_file, duplicate_file,
+            window=self.window, streaming=self.streaming, directional_ratio=self.directional_ratio, max_memory=self.max_memory,
+            spill_dir=self.spill_dir, verbose=self.verbose)
+
+    def dedup(self, records):
+        """
+        Dedup one sample and yield (kind, line) for every header line, kept read, and duplicate (only with store_duplicates).
+        Nothing carries over from one call to the next except the UMIs.
+        """
+        kept_reads = LineCollector()
+        duplicates = LineCollector() if self.store_duplicates == True else None
+        engine = self.make_engine(kept_reads, duplicates)
+
+        # The numpy engine works on chunks of reads instead of one read at a time
+        batch = list()
+
+        for sam_line in split_lines(records):
+            if sam_line.startswith('@'):
+                yield 'header', sam_line
+                continue
+
+            if self.engine == 'numpy':
+                batch.append(sam_line)
+                if len(batch) < self.chunk_size:
+                    continue
+                engine.add_reads(batch)
+                batch = list()
+            else:
+                engine.add_read(sam_line)
+
+            yield from self.drain(kept_reads, duplicates)
+
+        # Dedup the last partial chunk and hand back what is left
+        if batch:
+            engine.add_reads(batch)
+        engine.flush()
+        yield from self.drain(kept_reads, duplicates)
+
+    def drain(self, kept_reads, duplicates):
+        """Yield the reads the engine has written out so far"""
+        if duplicates != None:
+            for sam_line in duplicates.drain():
+                yield 'duplicate', sam_line
+        for sam_line in kept_reads.drain():
+            yield 'kept', sam_line
@@ -0,0 +1,427 @@
+"""
+The dictionary version of the dedup logic, which checks one read at a time. Every read is broken down into its UMI, strand
+and clip adjusted 5' position, and the kept read for each of those keys is held in a dictionary until the chromosome
+changes. Everything this needs is passed in when it is made instead of being read from the command line arguments, so the
+same engine is used by powers_deduper.py and by the Deduper class in deduper_api.py.
+"""
+
+import collections
+import os
+import sys
+
+import cigar_offsets
+import external_sort
+import spill
+import umi_clustering
+import umi_keys
+
+
+def get_important_information(read_file_line: str):
+    """
+    This function takes in a SAM file line and spits out the important information for that is needed so you can check
+    to see if that read is a duplicate or not.
+    """
+    # Split the line into a list
+    full_line = read_file_line.strip('\n').split('\t')
+
+    # store important variables that are needed to check
+    qname, flag, rname, pos, cigar, quality_score = full_line[0], full_line[1], full_line[2], full_line[3], full_line[5], full_line[10]
+
+    # pull out the umi from the qname
+    umi_qname = qname.split(':')[-1]
+
+    # return the strand from the flag
+    strand = check_strand(flag)
+
+    return read_file_line, umi_qname, strand, rname, pos, cigar, quality_score
+
+def add_cigar_to_pos(cigar_variable, position, strand):
+    """
+    Add the soft clipped ends to the beginning of the start position. This will be used for comparison with the positions in the
+    UMI dict
+    If the strand is forward then it would subtract the soft clipped end to the 5' of the forward start position.
+    If the strand is reverse then it would add the soft clipped end to the 5' of the reverse start position.
+    The offsets for each CIGAR string are worked out once and cached in cigar_offsets.
+    """
+    forward_offset, reverse_offset = cigar_offsets.five_prime_offsets(cigar_variable)
+
+    # Forward reads move back by the soft clipping at the start
+    if strand == 'forward':
+        return int(position) + forward_offset
+
+    # Reverse reads move up to the 5' end on the right side
+    else:
+        return int(position) + reverse_offset
+
+def check_strand(bitflag):
+    """Check the bitflag to know if the strand is reversed or not"""
+    if ((int(bitflag) & 16) == 16):
+        return 'reverse'
+    else:
+        return 'forward'
+
+def instantiate_umi_set(umi_file: str) -> set:
+    """
+    Creates a set of unique umis that will be used for reference to throw out bad UMI reads. If no known UMIs then we will create
+    not create this
+    """
+    # Create the dictionary that will be used
+    temp_set = set()
+
+    # If umi file isn't set/ no know UMIs
+    if umi_file == 'random':
+
+        return temp_set
+
+    else:
+        # UMi file open and store as a variable
+        with open(umi_file, 'r') as file:
+
+            # first read in the lines
+            for umi_line in file:
+
+                # Make the umis from the file the keys for this dict
+                temp_set.add(umi_line.strip('\n'))
+
+    return temp_set
+
+def mean_quality(quality_score: str) -> float:
+    """
+    Get the mean phred 33 score of the quality string. The bytes are summed in one go instead of building a list of scores,
+    and this is only done once per read so the score can be stored next to the kept read.
+    """
+    return (sum(quality_score.encode()) - 33 * len(quality_score)) / len(quality_score)
+
+def byte_length(sam_line: str) -> int:
+    """
+    Get the length of a decoded line in bytes, which is what the offsets into the input file count. It is only different
+    from the number of characters when the line has non-ASCII characters in it, and isascii doesn't have to look at them.
+    """
+    return len(sam_line) if sam_line.isascii() else len(sam_line.encode())
+
+
+class DictDedupEngine:
+    """
+    Holds the dictionary of kept reads for the current chromosome.
+
+    umi_ids holds the known UMIs mapped to their integer ids from umi_keys.number_umis, and is empty for random UMIs.
+    Duplicates are only written if a duplicate_file is given. With a window, reads that fall more than window bases behind
+    the current position are written out as the file goes (-w). With streaming, every read is written as soon as it is first
+    seen and only its key is kept (-st). With a directional_ratio, random UMIs are clustered when the chromosome is finished
+    (-dc). With an input_map, only the byte offset and length of each kept read are stored and the line is sliced back out of
+    the memory mapped input (-os). With a max_memory in bytes, the dictionary is spilled to sorted runs in spill_dir whenever
+    the reads in it go over the budget, and the runs are merged when the chromosome is finished (-mm). on_keys_merged is called
+    with the chromosome and the number of stored keys that turned out to be duplicates after all, which are the keys found in
+    more than one run with -mm and the UMIs clustered into another UMI with -dc.
+
+    storing_dict can be swapped for a dictionary that keeps stats, and on_new_chrom is called with the engine, the new
+    chromosome and the offset of its first line every time a chromosome is started after the old one is written out. With
+    verbose, every new chromosome and spill is printed to stderr.
+    """
+
+    def __init__(self, umi_ids, random_umis, quality, output_file, duplicate_file=None, window=None, streaming=False,
+        directional_ratio=None, input_map=None, storing_dict=None, on_new_chrom=None, last_chrom=None, max_memory=None, spill_dir=None,
+        on_keys_merged=None, verbose=False):
+        self.umi_set = umi_ids
+        self.random_umis = random_umis
+        self.quality = quality
+        self.output_file = output_file
+        self.duplicate_file = duplicate_file
+        self.store_duplicates = duplicate_file != None
+        self.window = window
+        self.streaming = streaming
+        self.directional_ratio = directional_ratio
+        self.input_map = input_map
+        self.offset_storage = input_map != None
+        self.on_new_chrom = on_new_chrom
+        self.verbose = verbose
+
+        # Storing dict
+        self.storing_dict = storing_dict if storing_dict != None else dict()
+
+        # Only keep track of the read positions if we are evicting reads, which also needs the reads to be sorted by POS
+        self.eviction_queue = collections.deque() if window != None else None
+        self.last_position = 0
+
+        # Bytes of reads in the dictionary, the runs spilled to disk for this chromosome, and the number of keys in them
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.stored_bytes = 0
+        self.spill_paths = list()
+        self.spilled_keys = 0
+        self.on_keys_merged = on_keys_merged
+
+        # Number of reads seen for each key in the dictionary, which is only kept for directional clustering
+        self.read_counts = collections.Counter()
+
+        # The chromosome that is being worked on and every one that has been started, so unsorted input can be caught
+        self.last_chrom = last_chrom
+        self.started_chroms = {last_chrom} if last_chrom != None else set()
+
+        # The functions that break down each read, which --stats swaps for timed versions
+        self.get_important_information = get_important_information
+        self.add_cigar_to_pos = add_cigar_to_pos
+
+    def add_read(self, read_line: str, line_offset=None):
+        """Dedup one SAM read line. line_offset is where the line starts in the input, which is only needed with an input_map."""
+        # The last line of a file can be missing its newline, and a kept read isn't always written out last
+        if not read_line.endswith('\n'):
+            read_line += '\n'
+        self.last_chrom = self.store_or_check_read_against_dict(read_line, line_offset)
+
+    def flush(self):
+        """Write out every read that is left, which has to be done at the end since the last chromosome never changes"""
+        if self.spill_paths:
+            self.write_spilled_reads()
+        else:
+            self.write_stored_reads()
+        self.storing_dict.clear()
+        self.stored_bytes = 0
+        if self.eviction_queue != None:
+            self.eviction_queue.clear()
+
+    def make_stored_read(self, full_line, read_score, line_offset):
+        """
+        Make the value that gets stored in the dictionary for a read. Normally this is the whole line, but with an input_map it
+        is only the byte offset and length of the line in the input file. The mean quality score (None without quality) is
+        always last.
+        """
+        if self.offset_storage == True:
+            return (line_offset, byte_length(full_line), read_score)
+        else:
+            return (full_line, read_score)
+
+    def get_stored_line(self, stored_read) -> str:
+        """Get the SAM line back for a stored read, slicing it out of the memory mapped input if only the offset was kept"""
+        if self.offset_storage == True:
+            return self.input_map[stored_read[0]:stored_read[0] + stored_read[1]].decode()
+        else:
+            return stored_read[0]
+
+    def merge_directional_clusters(self):
+        """
+        Cluster the UMIs at each strand and 5' position with umi_clustering.directional_clusters and only keep one read for each
+        cluster. The read that is kept is the one for the head of the cluster, or with quality the best read in the cluster. The
+        rest are taken out of the dictionary and written to the duplicate file if there is one.
+        """
+        storing_dict = self.storing_dict
+        clustered_keys = 0
+
+        # Group the keys by strand and 5' position
+        position_groups = collections.defaultdict(dict)
+        for key in storing_dict:
+            umi, position = umi_keys.split_key(key)
+            position_groups[position][umi] = key
+
+        for umi_to_key in position_groups.values():
+            # A single UMI is a cluster on its own
+            if len(umi_to_key) == 1:
+                continue
+
+            cluster_heads = umi_clustering.directional_clusters({umi: self.read_counts[key] for umi, key in umi_to_key.items()},
+                self.directional_ratio)
+
+            for umi, head in cluster_heads.items():
+                if umi == head:
+                    continue
+                head_key = umi_to_key[head]
+                stored_read = storing_dict.pop(umi_to_key[umi])
+                clustered_keys += 1
+
+                # The better read takes the place of the head read, the same as a duplicate with quality
+                if self.quality == True and stored_read[-1] > storing_dict[head_key][-1]:
+                    stored_read, storing_dict[head_key] = storing_dict[head_key], stored_read
+
+                if self.store_duplicates == True:
+                    self.duplicate_file.write(self.get_stored_line(stored_read))
+
+        self.read_counts.clear()
+        if self.on_keys_merged != None and clustered_keys > 0:
+            self.on_keys_merged(self.last_chrom, clustered_keys)
+
+    def write_stored_reads(self):
+        """
+        Write out every read that is in the dictionary. With an input_map the reads are written in the order of their offsets,
+        which means the memory mapped input is read from front to back. With directional clustering the UMI clusters are merged
+        first.
+        """
+        # When streaming every read has already been written
+        if self.streaming == True:
+            return
+
+        if self.directional_ratio != None:
+            self.merge_directional_clusters()
+
+        if self.offset_storage == True:
+            for stored_read in sorted(self.storing_dict.values()):
+                self.output_file.write(self.get_stored_line(stored_read))
+        else:
+            for key in self.storing_dict:
+                self.output_file.write(self.storing_dict[key][0])
+
+    def spill(self):
+        """
+        Write the dictionary out to a run sorted by key and empty it. Every key is given a sequence number in the order it
+        was added, counting on from the runs before, so the kept reads can be put back in that order.
+        """
+        entries = sorted((str(key), self.spilled_keys + sequence, stored_read[-1], stored_read[0])
+            for sequence, (key, stored_read) in enumerate(self.storing_dict.items()))
+        self.spill_paths.append(spill.write_key_run(entries, self.spill_dir))
+        self.spilled_keys += len(self.storing_dict)
+        self.storing_dict.clear()
+        self.stored_bytes = 0
+        if self.verbose:
+            print('Reads Spilled To Disk:', len(self.spill_paths), sep='\t', file=sys.stderr)
+
+    def write_spilled_reads(self):
+        """
+        Spill what is left in the dictionary and merge all of the runs of this chromosome. The duplicates across the runs are
+        written as they are found, and the kept reads are written in the order their keys were first seen.
+        """
+        self.spill()
+        merged_keys = 0
+
+        def kept_reads():
+            nonlocal merged_keys
+            for sequence, kept_line, duplicate_lines in spill.resolve_runs(self.spill_paths, self.quality):
+                merged_keys += len(duplicate_lines)
+                if self.store_duplicates == True:
+                    for duplicate_line in duplicate_lines:
+                        self.duplicate_file.write(duplicate_line)
+                yield sequence, kept_line
+
+        try:
+            for kept_line in spill.sort_by_sequence(kept_reads(), self.max_memory, self.spill_dir):
+                self.output_file.write(kept_line)
+            if self.on_keys_merged != None:
+                self.on_keys_merged(self.last_chrom, merged_keys)
+        finally:
+            for spill_path in self.spill_paths:
+                os.remove(spill_path)
+            self.spill_paths = list()
+            self.spilled_keys = 0
+
+    def evict_passed_reads(self, position):
+        """
+        Write out and remove the reads that can not be matched anymore. Since the file is sorted by position, any read that comes
+        after this one can only have a 5' position that is at most window bases before the current position. The queue holds
+        (5' position, key) in the order the keys were added, so taking off the front keeps the output in the same order as if the
+        whole chromosome had been held in the dictionary.
+        """
+        eviction_queue = self.eviction_queue
+        while eviction_queue and eviction_queue[0][0] + self.window < position:
+            five_prime_pos, key = eviction_queue.popleft()
+            stored_read = self.storing_dict.pop(key)
+
+            # When streaming the read was already written when it was first seen
+            if self.streaming != True:
+                self.output_file.write(self.get_stored_line(stored_read))
+
+    def store_or_check_read_against_dict(self, read_line, line_offset=None):
+        """Take in a read and checks to see if this read already exists in the dictionary. If it does not then it is stored into the dictionary.
+        This will be the main chunk of code that will be running for our analysis.
+
+
+        dictionary example:
+
+        dict = {
+            umi_keys.pack_key(umi_qname, strand, updated_pos): (whole read, mean quality score)
+            }
+
+        Returns the chromosome of the read, which is the last chromosome for the next read.
+        """
+        storing_dict = self.storing_dict
+        umi_set = self.umi_set
+
+        # First we break the line into multiple parts
+        full_line, umi_qname, strand, rname, pos, cigar, quality_score = self.get_important_information(read_line)
+
+        ################# We need to check what chromosome we are on, if it is a new one then write all reads to the file and clear the dictionary.
+
+        if self.last_chrom != rname:
+                # If this chromosome was already finished then the input isn't sorted
+                if rname in self.started_chroms:
+                    raise ValueError(external_sort.UNSORTED_MESSAGE.format(rname))
+                self.started_chroms.add(rname)
+                self.last_position = int(pos)
+
+                # Iter through the dict and write them to the output file, and clear the dictionary as we are on a new chromosome now
+                self.flush()
+
+                # Everything before this read is finished so it is a safe point to pick up from
+                if self.on_new_chrom != None:
+                    self.on_new_chrom(self, rname, line_offset)
+                if self.verbose:
+                    print('New Chrom Started:', rname, sep='\t', file=sys.stderr)
+
+        # Write out the reads that are too far behind to ever be matched again. A read that goes back in POS would have been
+        # matched against reads that were already written out, so stop instead of giving wrong results.
+        elif self.eviction_queue != None:
+            position = int(pos)
+            if position < self.last_position:
+                raise ValueError(external_sort.UNSORTED_POSITION_MESSAGE.format(rname))
+            self.last_position = position
+            self.evict_passed_reads(position)
+
+
+    ################# Dictionary is sorted now we can check/store new entries into/against the dict
+
+        # Throw out the reads whose UMI doesn't pass. Random UMIs can't have any Ns, and known UMIs have to be in the set.
+        if self.random_umis == True:
+            umi_passes = 'N' not in umi_qname
+        else:
+            umi_passes = umi_qname in umi_set
+        if umi_passes != True:
+            return rname
+
+        # Update the position if it needs to be changed from soft clipping
+        updated_pos = self.add_cigar_to_pos(cigar, pos, strand)
+
+        # Create the key needed to be checked and or put into the dict. The key is packed into an integer to save memory.
+        read_key = umi_keys.pack_key(umi_qname, strand == 'reverse', updated_pos, umi_set)
+
+        # Work out the mean quality score once, it is stored with the read so it never has to be worked out again
+        if self.quality == True:
+            read_score = mean_quality(quality_score)
+        else:
+            read_score = None
+
+        # Count the reads for each UMI so they can be clustered, which is only done for random UMIs
+        if self.directional_ratio != None:
+            self.read_counts[read_key] += 1
+
+        # Check to see if it is in the dict
+        if read_key in storing_dict:
+
+            # We need to check to see if the user wants higher quality scores
+            if self.quality == True and read_score > storing_dict[read_key][-1]:
+
+                # check duplicate store option
+                if self.store_duplicates == True:
+                    self.duplicate_file.write(self.get_stored_line(storing_dict[read_key]))
+
+                # Replace the read with the better quality one.
+                storing_dict[read_key] = self.make_stored_read(full_line, read_score, line_offset)
+
+            # Otherwise we already have this entry present, so only write it out if the user wants duplicates stored
+            elif self.store_duplicates == True:
+                self.duplicate_file.write(full_line)
+
+            return rname
+
+        # There is no entry in the dict yet, this is a new read. We have to add it.
+        # When streaming the read is written out right away and only the key is kept
+        if self.streaming == True:
+            self.output_file.write(full_line)
+            storing_dict[read_key] = None
+        else:
+            storing_dict[read_key] = self.make_stored_read(full_line, read_score, line_offset)
+
+            # Spill the dictionary to disk once the reads in it go over the memory budget
+            if self.max_memory != None:
+                self.stored_bytes += len(full_line) + spill.ENTRY_OVERHEAD
+                if self.stored_bytes > self.max_memory:
+                    self.spill()
+        if self.eviction_queue != None:
+            self.eviction_queue.append((updated_pos, read_key))
+        return rname
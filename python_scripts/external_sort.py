@@ -0,0 +1,127 @@
+"""
+Disk backed sort for SAM files that aren't sorted, so they can be deduped without running a separate sort first. The reads
+are read in until the memory budget is used up, sorted, and written to a temporary run file. Once the whole input has been
+read, the runs are merged back together with a k-way merge and the sorted lines are handed straight to the dedup loop, so
+the sorted file is never written out in full.
+
+Reads are sorted by chromosome (in the order of the @SQ lines, then in the order they were first seen) and then by the
+clip adjusted 5' position, or by POS for paired reads since the mate buffer works on POS. Reads with the same key stay in
+the order they were in the file, so the first read of a set of duplicates is the same one that would be kept from a
+stably sorted file.
+"""
+
+import heapq
+import os
+import sys
+import tempfile
+
+import cigar_offsets
+
+
+# Error for input that isn't sorted. The dict, numpy and paired engines all raise this when a chromosome shows up again.
+UNSORTED_MESSAGE = 'The reads of chromosome {} are not all together, so the input is not sorted. Please sort it first or pass -so True'
+UNSORTED_POSITION_MESSAGE = 'The reads of chromosome {} are not sorted by position. Please sort it first or pass -so True'
+
+# Unmapped reads with no chromosome go after every chromosome
+UNMAPPED_RANK = 1 << 62
+
+
+class ChromRanks:
+    """Gives each chromosome its place in the sort. The @SQ lines come first, then chromosomes in the order they were seen."""
+
+    def __init__(self):
+        self.ranks = dict()
+
+    def add_header_line(self, header_line: str):
+        """Give the chromosome of an @SQ line the next rank"""
+        if header_line.startswith('@SQ'):
+            for field in header_line.rstrip('\n').split('\t')[1:]:
+                if field.startswith('SN:') and field[3:] not in self.ranks:
+                    self.ranks[field[3:]] = len(self.ranks)
+
+    def get_rank(self, rname: str) -> int:
+        if rname == '*':
+            return UNMAPPED_RANK
+        if rname not in self.ranks:
+            self.ranks[rname] = len(self.ranks)
+        return self.ranks[rname]
+
+
+def get_sort_key(read_line: str, chrom_ranks, by_five_prime: bool):
+    """The (chromosome rank, position) a read is sorted on"""
+    columns = read_line.split('\t', 6)
+    pos = int(columns[3])
+    if by_five_prime:
+        forward_offset, reverse_offset = cigar_offsets.five_prime_offsets(columns[5])
+        pos += reverse_offset if (int(columns[1]) & 16) == 16 else forward_offset
+    return chrom_ranks.get_rank(columns[2]), pos
+
+def write_run(run_reads, sort_dir: str) -> str:
+    """Sort a run of (chromosome rank, position, read number, line) and write it to a temporary file, returning its path"""
+    run_reads.sort()
+    run_descriptor, run_path = tempfile.mkstemp(prefix='deduper_sort_', suffix='.run', dir=sort_dir)
+    with os.fdopen(run_descriptor, 'w') as run_file:
+        for rank, pos, read_number, read_line in run_reads:
+            run_file.write(f'{rank}\t{pos}\t{read_number}\t{read_line}')
+    return run_path
+
+def read_run(run_path: str):
+    """Read a run back in as (chromosome rank, position, read number, line)"""
+    with open(run_path) as run_file:
+        for run_line in run_file:
+            rank, pos, read_number, read_line = run_line.split('\t', 3)
+            yield int(rank), int(pos), int(read_number), read_line
+
+def sort_sam_lines(sam_lines, memory_budget: int, sort_dir=None, by_five_prime=True):
+    """
+    Yield the header lines and then the reads in sorted order. Runs are spilled to sort_dir once the lines held in memory
+    add up to more than memory_budget bytes. If everything fits in one run then it is sorted in memory and nothing is
+    written to disk.
+    """
+    chrom_ranks = ChromRanks()
+    run_reads = list()
+    run_bytes = 0
+    run_paths = list()
+
+    try:
+        read_number = 0
+        for sam_line in sam_lines:
+            # The header comes before the reads so it can go straight out
+            if sam_line.startswith('@'):
+                chrom_ranks.add_header_line(sam_line)
+                yield sam_line
+                continue
+
+            # Every line is stored with a newline so the runs can be read back in one line at a time
+            if not sam_line.endswith('\n'):
+                sam_line += '\n'
+
+            rank, pos = get_sort_key(sam_line, chrom_ranks, by_five_prime)
+            run_reads.append((rank, pos, read_number, sam_line))
+            read_number += 1
+
+            run_bytes += len(sam_line)
+            if run_bytes >= memory_budget:
+                run_paths.append(write_run(run_reads, sort_dir))
+                print('Sort Run Written:', len(run_paths), sep='\t', file=sys.stderr)
+                run_reads = list()
+                run_bytes = 0
+
+        # Everything fit in memory
+        if not run_paths:
+            run_reads.sort()
+            for rank, pos, read_number, read_line in run_reads:
+                yield read_line
+            return
+
+        if run_reads:
+            run_paths.append(write_run(run_reads, sort_dir))
+        run_reads = list()
+
+        # Merge the runs. The read numbers are all different so the lines themselves are never compared.
+        for rank, pos, read_number, read_line in heapq.merge(*[read_run(run_path) for run_path in run_paths]):
+            yield read_line
+
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
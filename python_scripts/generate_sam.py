@@ -0,0 +1,125 @@
+"""
+Make a sorted synthetic single end SAM file for benchmarking and checking the deduper. Everything comes from one seeded
+random generator so the same arguments always give the same file. A duplicate copies the UMI, strand and 5' position of an
+earlier read but gets its own soft clipping and quality string, so the soft clip adjustment is exercised too.
+"""
+
+import argparse
+import random
+import sys
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Make a sorted synthetic SAM file with UMIs in the QNAMEs')
+    parser.add_argument('-n', '--reads', help='Number of reads to make. Default=100000', default=100000, type=int)
+    parser.add_argument('-c', '--chromosomes', help='Number of chromosomes the reads are spread across. Default=3', default=3, type=int)
+    parser.add_argument('-l', '--chrom_length', help='Length of each chromosome. Default=1000000', default=1000000, type=int)
+    parser.add_argument('-rl', '--read_length', help='Length of each read. Default=50', default=50, type=int)
+    parser.add_argument('-dr', '--duplicate_rate', help='Fraction of reads that are duplicates of an earlier read. Default=0.3', \
+        default=0.3, type=float)
+    parser.add_argument('-sc', '--softclip_rate', help='Fraction of reads that have soft clipping on each end. Default=0.2', \
+        default=0.2, type=float)
+    parser.add_argument('-rs', '--reverse_rate', help='Fraction of reads on the reverse strand. Default=0.5', default=0.5, type=float)
+    parser.add_argument('-nr', '--n_rate', help='Fraction of reads with an N in the UMI. Default=0.01', default=0.01, type=float)
+    parser.add_argument('-u', '--umi', help='Path to a UMI file separated by newlines to pick the UMIs from. Default=random, which \
+        makes random UMIs of length -ul', default='random', type=str)
+    parser.add_argument('-ul', '--umi_length', help='Length of the random UMIs. Default=8', default=8, type=int)
+    parser.add_argument('-s', '--seed', help='Seed for the random generator. Default=1', default=1, type=int)
+    parser.add_argument('-o', '--output', help='Path to write the SAM file to, or - for stdout. Default=-', default='-', type=str)
+    return parser.parse_args()
+
+def check_args(args):
+    """Make sure the numbers make sense"""
+    if args.reads < 0 or args.chromosomes < 1 or args.read_length < 1:
+        raise ValueError('The number of reads can not be negative and there has to be at least one chromosome and one base per read')
+    if args.chrom_length <= 2 * args.read_length:
+        raise ValueError('The chromosomes have to be more than twice as long as the reads. Please pass a bigger number to -l')
+    for rate in (args.duplicate_rate, args.softclip_rate, args.reverse_rate, args.n_rate):
+        if rate < 0 or rate > 1:
+            raise ValueError('The rates have to be between 0 and 1')
+
+def make_cigar(generator, read_length: int, softclip_rate: float):
+    """Make the CIGAR for a read, returning the leading soft clip, the bases that match, the trailing soft clip and the CIGAR"""
+    leading_clip = generator.randint(1, read_length // 4) if generator.random() < softclip_rate and read_length >= 4 else 0
+    trailing_clip = generator.randint(1, read_length // 4) if generator.random() < softclip_rate and read_length >= 4 else 0
+    matched = read_length - leading_clip - trailing_clip
+
+    cigar = f'{matched}M'
+    if leading_clip:
+        cigar = f'{leading_clip}S' + cigar
+    if trailing_clip:
+        cigar += f'{trailing_clip}S'
+    return leading_clip, matched, trailing_clip, cigar
+
+def make_umi(generator, umis, umi_length: int, n_rate: float) -> str:
+    """Pick a UMI from the list, or make a random one, with an N put in for n_rate of them"""
+    if umis:
+        umi = generator.choice(umis)
+    else:
+        umi = ''.join(generator.choice('ACGT') for _ in range(umi_length))
+    if generator.random() < n_rate:
+        position = generator.randrange(len(umi))
+        umi = umi[:position] + 'N' + umi[position + 1:]
+    return umi
+
+def generate_reads(args):
+    """Make the reads, returning them as (chromosome number, POS, SAM line) in sorted order"""
+    generator = random.Random(args.seed)
+
+    # Load the known UMIs if there are any
+    if args.umi == 'random':
+        umis = None
+    else:
+        with open(args.umi) as umi_file:
+            umis = [umi_line.strip() for umi_line in umi_file if umi_line.strip()]
+
+    reads = list()
+    # (chromosome, UMI, strand, 5' position) of every read so far, which the duplicates are copied from
+    originals = list()
+    for read_number in range(args.reads):
+        if originals and generator.random() < args.duplicate_rate:
+            chrom, umi, reverse, five_prime = generator.choice(originals)
+        else:
+            chrom = generator.randrange(args.chromosomes)
+            umi = make_umi(generator, umis, args.umi_length, args.n_rate)
+            reverse = generator.random() < args.reverse_rate
+            five_prime = generator.randint(args.read_length + 1, args.chrom_length - args.read_length)
+            originals.append((chrom, umi, reverse, five_prime))
+
+        # Work out the POS that gives this 5' position with this CIGAR, the same way cigar_offsets does it
+        leading_clip, matched, trailing_clip, cigar = make_cigar(generator, args.read_length, args.softclip_rate)
+        if reverse:
+            pos = five_prime - matched - trailing_clip
+        else:
+            pos = five_prime + leading_clip
+
+        sequence = ''.join(generator.choice('ACGT') for _ in range(args.read_length))
+        quality = ''.join(chr(generator.randint(35, 73)) for _ in range(args.read_length))
+        flag = 16 if reverse else 0
+        reads.append((chrom, pos, f'SYN:{read_number}:{umi}\t{flag}\tchr{chrom + 1}\t{pos}\t36\t{cigar}\t*\t0\t0\t{sequence}\t{quality}\n'))
+
+    reads.sort(key=lambda read: (read[0], read[1]))
+    return reads
+
+def write_sam(args, reads, sam_file):
+    """Write the header and the reads"""
+    sam_file.write('@HD\tVN:1.6\tSO:coordinate\n')
+    for chrom in range(args.chromosomes):
+        sam_file.write(f'@SQ\tSN:chr{chrom + 1}\tLN:{args.chrom_length}\n')
+    for chrom, pos, read_line in reads:
+        sam_file.write(read_line)
+
+########################################## Script Logic
+
+if __name__ == '__main__':
+
+    args = get_args()
+    check_args(args)
+
+    reads = generate_reads(args)
+
+    if args.output == '-':
+        write_sam(args, reads, sys.stdout)
+    else:
+        with open(args.output, 'w') as sam_file:
+            write_sam(args, reads, sam_file)
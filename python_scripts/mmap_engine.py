@@ -0,0 +1,116 @@
+"""
+Dedup engine that works straight off of a memory mapped SAM file with sam_scanner. The dictionary only holds the byte
+offsets of the kept reads, and the reads are written out as memoryview slices of the map so the lines are never decoded.
+The output is the same as DictDedupEngine in dict_engine.py with -os in powers_deduper.py.
+"""
+
+import sys
+
+import cigar_offsets
+import external_sort
+import umi_keys
+from sam_scanner import scan_records
+
+
+class MmapDedupEngine:
+    """Holds the kept reads for the current chromosome as {key: (line start, line end, quality)}"""
+
+    def __init__(self, input_map, umi_ids, random_umis, quality, output_file, duplicate_file=None, verbose=False):
+        self.input_map = input_map
+        self.input_view = memoryview(input_map)
+        self.random_umis = random_umis
+        self.quality = quality
+        self.verbose = verbose
+
+        # The known UMIs are looked up by their bytes so they never have to be decoded
+        self.umi_ids = {umi.encode(): umi_id for umi, umi_id in umi_ids.items()}
+
+        # Everything up to now was written as text, so flush it out before writing bytes
+        self.write_output = get_bytes_writer(output_file)
+        self.write_duplicate = get_bytes_writer(duplicate_file) if duplicate_file != None else None
+
+        # The chromosome that is being worked on and every one that has been started
+        self.chrom = None
+        self.started_chroms = set()
+        self.read_dict = dict()
+
+    def flush(self):
+        """Write out every kept read for the current chromosome in file order and clear out the dictionary"""
+        for line_start, line_end, quality_score in sorted(self.read_dict.values()):
+            self.write_output(self.input_view[line_start:line_end])
+        self.read_dict.clear()
+
+    def close(self):
+        """Let go of the view of the memory map, which has to be done before the map can be closed"""
+        self.input_view.release()
+
+    def dedup_range(self, start, end):
+        """Dedup the reads between the byte offsets start and end"""
+        read_dict = self.read_dict
+        umi_ids = self.umi_ids
+
+        for line_start, line_end, umi, flag, rname, pos, cigar, quality_score in \
+                scan_records(self.input_map, start, end, self.quality):
+
+            # If it is a new chromosome then write all reads to the file and clear the dictionary
+            if rname != self.chrom:
+                if rname in self.started_chroms:
+                    raise ValueError(external_sort.UNSORTED_MESSAGE.format(rname.decode()))
+                self.started_chroms.add(rname)
+                self.flush()
+                self.chrom = rname
+                if self.verbose:
+                    print('New Chrom Started:', rname.decode(), sep='\t', file=sys.stderr)
+
+            # Throw out the reads with UMIs that have Ns or that aren't known
+            if self.random_umis:
+                if b'N' in umi:
+                    continue
+                umi_code = umi_keys.pack_umi(umi.decode())
+            else:
+                umi_code = umi_ids.get(umi)
+                if umi_code == None:
+                    continue
+
+            # Build the key from the strand and 5' position
+            reverse = flag & 16 == 16
+            forward_offset, reverse_offset = cigar_offsets.five_prime_offsets(cigar)
+            five_prime = pos + (reverse_offset if reverse else forward_offset)
+            if umi_code == None:
+                read_key = (umi, reverse, five_prime)
+            else:
+                read_key = (umi_code << umi_keys.UMI_SHIFT) | (reverse << umi_keys.STRAND_SHIFT) | \
+                    (five_prime + umi_keys.POSITION_BIAS)
+
+            # Work out the quality score once so it is stored alongside the read
+            if self.quality:
+                score = (sum(quality_score) - 33 * len(quality_score)) / len(quality_score)
+            else:
+                score = 0
+
+            stored_read = read_dict.get(read_key)
+
+            # There is no entry in the dict yet, this is a new read
+            if stored_read == None:
+                read_dict[read_key] = (line_start, line_end, score)
+
+            # The new read is better so it replaces the one being kept
+            elif self.quality and score > stored_read[2]:
+                if self.write_duplicate != None:
+                    self.write_duplicate(self.input_view[stored_read[0]:stored_read[1]])
+                read_dict[read_key] = (line_start, line_end, score)
+
+            # This read is a duplicate
+            elif self.write_duplicate != None:
+                self.write_duplicate(self.input_view[line_start:line_end])
+
+def get_bytes_writer(output_file):
+    """
+    Return a function that writes bytes to the output file. Text files are written to through their buffer (after flushing
+    the text that is already waiting), and anything else like a BamWriter gets the decoded text.
+    """
+    if hasattr(output_file, 'buffer'):
+        output_file.flush()
+        return output_file.buffer.write
+    else:
+        return lambda data: output_file.write(bytes(data).decode())
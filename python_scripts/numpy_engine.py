@@ -0,0 +1,298 @@
+"""
+Batch version of the dedup logic that works on large chunks of reads at a time with NumPy instead of one read at a time.
+The UMI, FLAG, RNAME, POS and CIGAR of each read in the chunk are pulled straight out of the bytes of the chunk into
+arrays, the strand and 5' positions are worked out on the whole array at once, and the duplicates are found with a sort
+over integer keys. The output is the same as DictDedupEngine in dict_engine.py, down to the order of the reads and the
+duplicates.
+"""
+
+import sys
+
+import numpy as np
+
+import cigar_offsets
+import external_sort
+from umi_keys import MAX_PACKED_UMI_LENGTH, POSITION_BIAS, STRAND_SHIFT, UMI_SHIFT
+
+
+# The bytes the columns are found by
+NEWLINE, TAB, COLON = ord('\n'), ord('\t'), ord(':')
+ZERO = ord('0')
+N_BASE = ord('N')
+
+# The base 4 digit of every byte for packing random UMIs the same as umi_keys.pack_umi. The padding after a UMI is 0 and
+# every other byte is -1, which can't be packed.
+BASE_CODES = np.full(256, -1, dtype=np.int64)
+BASE_CODES[[0, ord('A'), ord('C'), ord('G'), ord('T')]] = [0, 0, 1, 2, 3]
+
+
+def unique_fields(data, starts, ends):
+    """
+    Find the different values of a column in a chunk. Each field is copied into a row of a fixed width array of bytes, so
+    NumPy can compare them all at once. Returns the different values as bytes and the index of every field into them.
+    """
+    width = max(int((ends - starts).max()), 1)
+    field_index = starts[:, None] + np.arange(width)
+    in_field = field_index < ends[:, None]
+    fields = np.where(in_field, data[np.minimum(field_index, len(data) - 1)], 0).astype(np.uint8)
+    unique_values, value_index = np.unique(fields.view(f'S{width}').reshape(-1), return_inverse=True)
+    return unique_values, value_index.reshape(-1)
+
+def parse_numbers(data, starts, ends, read_lines):
+    """Turn a column of whole numbers into an array, one digit at a time for every field at once"""
+    numbers = np.zeros(len(starts), dtype=np.int64)
+    for digit_number in range(int((ends - starts).max())):
+        in_field = starts + digit_number < ends
+        digits = data[np.minimum(starts + digit_number, len(data) - 1)].astype(np.int64) - ZERO
+        if ((digits < 0) | (digits > 9))[in_field].any():
+            bad_line = read_lines[int(np.argmax(in_field & ((digits < 0) | (digits > 9))))]
+            raise ValueError(f'FLAG and POS have to be whole numbers: {bad_line.strip()}')
+        numbers = np.where(in_field, numbers * 10 + digits, numbers)
+    return numbers
+
+
+class NumpyDedupEngine:
+    """
+    Holds the reads that have been kept for the current chromosome. The kept keys are held in a sorted array so a whole chunk
+    can be checked against them with one searchsorted, and each key points to a slot in a list of the kept lines. The slots
+    are in the order the keys were first seen, which is the order the dict engine writes them out in.
+    """
+
+    def __init__(self, umi_set, random_umis, quality, output_file, duplicate_file=None, verbose=False):
+        self.umi_set = umi_set
+        self.random_umis = random_umis
+        self.quality = quality
+        self.output_file = output_file
+        self.duplicate_file = duplicate_file
+        self.verbose = verbose
+
+        # Random UMIs are packed 2 bits to a base the same as umi_keys, so they don't need to be held anywhere. The few that
+        # can't be packed are given ids below -1 that only last for the current chromosome.
+        self.umi_ids = dict()
+
+        # The chromosome that is being worked on and every one that has been started
+        self.chrom = None
+        self.started_chroms = set()
+
+        # Sorted keys with the quality and slot of the read that is kept for each one
+        self.keys = np.empty(0, dtype=np.int64)
+        self.key_quality = np.empty(0, dtype=np.float64)
+        self.key_slot = np.empty(0, dtype=np.int64)
+
+        # The kept lines in the order their keys were first seen
+        self.kept_lines = list()
+
+    def get_umi_id(self, umi: str) -> int:
+        """Return the id of the UMI or -1 if this UMI should be thrown out"""
+        # Known UMIs use their ids from umi_set, so corrected UMIs share an id with the UMI they were corrected to
+        if not self.random_umis:
+            return self.umi_set.get(umi, -1)
+        return self.umi_ids.setdefault(umi, -2 - len(self.umi_ids))
+
+    def get_umi_codes(self, unique_umis):
+        """
+        Work out the part of the key for every different UMI in a chunk, or -1 if the UMI should be thrown out. Random UMIs
+        are packed all at once, and the ones that can't be packed are marked so they can be looked up for each chromosome.
+        """
+        if not self.random_umis:
+            umi_codes = np.array([self.get_umi_id(umi.decode()) for umi in unique_umis], dtype=np.int64)
+            return umi_codes, np.zeros(len(unique_umis), dtype=bool)
+
+        bases = unique_umis.view(np.uint8).reshape(len(unique_umis), unique_umis.itemsize)
+        lengths = np.count_nonzero(bases, axis=1)
+        base_codes = BASE_CODES[bases]
+
+        # Put a 1 in front so UMIs of different lengths don't collide, then add on each base
+        umi_codes = np.ones(len(unique_umis), dtype=np.int64)
+        for base_number in range(min(bases.shape[1], MAX_PACKED_UMI_LENGTH)):
+            umi_codes = np.where(base_number < lengths, umi_codes * 4 + base_codes[:, base_number], umi_codes)
+
+        has_n = (bases == N_BASE).any(axis=1)
+        packable = (base_codes >= 0).all(axis=1) & (lengths >= 1) & (lengths <= MAX_PACKED_UMI_LENGTH)
+        return np.where(has_n, -1, umi_codes), ~has_n & ~packable
+
+    def flush(self):
+        """Write out every kept read for the current chromosome and clear everything out"""
+        for kept_line in self.kept_lines:
+            self.output_file.write(kept_line)
+
+        self.keys = np.empty(0, dtype=np.int64)
+        self.key_quality = np.empty(0, dtype=np.float64)
+        self.key_slot = np.empty(0, dtype=np.int64)
+        self.kept_lines = list()
+
+        # The keys of the next chromosome don't need the ids of this one, so the UMIs that couldn't be packed can start over
+        self.umi_ids = dict()
+
+    def add_reads(self, read_lines):
+        """
+        Dedup a chunk of SAM read lines. The chunk is joined into one buffer of bytes and the tabs of every line are found
+        at once, so only the columns that are needed are ever pulled out and none of the lines are split in Python. The chunk
+        is split wherever the chromosome changes.
+        """
+        if not read_lines:
+            return
+
+        # Every line ends with a newline, even the last one of a file that doesn't, so a kept line never runs into the next one
+        if not read_lines[-1].endswith('\n'):
+            read_lines = read_lines[:-1] + [read_lines[-1] + '\n']
+        chunk = ''.join(read_lines).encode()
+        data = np.frombuffer(chunk, dtype=np.uint8)
+
+        line_ends = np.flatnonzero(data == NEWLINE)
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+        # The tabs that end the first 10 columns of every line. The 11th column (QUAL) ends at the next tab or the newline.
+        tabs = np.flatnonzero(data == TAB)
+        first_tab = np.searchsorted(tabs, line_starts)
+        tab_count = np.searchsorted(tabs, line_ends) - first_tab
+        if tab_count.min() < 10:
+            bad_line = read_lines[int(np.argmax(tab_count < 10))]
+            raise ValueError(f'SAM reads need at least 11 columns: {bad_line.strip()}')
+        column_ends = tabs[first_tab[:, None] + np.arange(10)]
+        quality_ends = np.where(tab_count > 10, tabs[np.minimum(first_tab + 10, len(tabs) - 1)], line_ends)
+
+        # The UMI is everything after the last colon in the QNAME
+        qname_ends = column_ends[:, 0]
+        colons = np.flatnonzero(data == COLON)
+        last_colon = np.searchsorted(colons, qname_ends) - 1
+        colon_at = colons[np.maximum(last_colon, 0)] if len(colons) else np.zeros(len(line_starts), dtype=np.int64)
+        umi_starts = np.where((last_colon >= 0) & (colon_at >= line_starts), colon_at + 1, line_starts)
+
+        unique_rnames, rname_index = unique_fields(data, column_ends[:, 1] + 1, column_ends[:, 2])
+        unique_umis, umi_index = unique_fields(data, umi_starts, qname_ends)
+        umi_codes, unpacked = self.get_umi_codes(unique_umis)
+        unique_cigars, cigar_index = unique_fields(data, column_ends[:, 4] + 1, column_ends[:, 5])
+        flags = parse_numbers(data, column_ends[:, 0] + 1, column_ends[:, 1], read_lines)
+        positions = parse_numbers(data, column_ends[:, 2] + 1, column_ends[:, 3], read_lines)
+
+        # Work out the strand and the 5' position of every read. Each different CIGAR is only looked at once per chunk.
+        strand = (flags & 16) != 0
+        offsets = np.array([cigar_offsets.five_prime_offsets(cigar.decode()) for cigar in unique_cigars], dtype=np.int64)
+        offsets = offsets.reshape(-1, 2)[cigar_index]
+        five_prime = positions + np.where(strand, offsets[:, 1], offsets[:, 0])
+
+        # The mean quality score of every read, the same as mean_quality in dict_engine.py since the sums are exact. The
+        # bounds go start, end, start, end so every other sum is one QUAL column.
+        if self.quality:
+            quality_starts = column_ends[:, 9] + 1
+            bounds = np.column_stack((quality_starts, quality_ends)).reshape(-1)
+            # The bytes are summed as 32 bit numbers, which is half the memory of 64 bit and can't overflow on a read
+            sums = np.add.reduceat(data, bounds, dtype=np.uint32)[::2].astype(np.int64)
+            lengths = quality_ends - quality_starts
+            read_quality = (sums - 33 * lengths) / lengths
+        else:
+            read_quality = np.zeros(len(line_starts), dtype=np.float64)
+
+        # Find where the chromosome changes in this chunk
+        boundaries = [0] + list(np.flatnonzero(rname_index[1:] != rname_index[:-1]) + 1) + [len(read_lines)]
+
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            rname = unique_rnames[rname_index[start]].decode()
+
+            # If it is a new chromosome then write all reads to the file and clear everything out
+            if rname != self.chrom:
+                if rname in self.started_chroms:
+                    raise ValueError(external_sort.UNSORTED_MESSAGE.format(rname))
+                self.started_chroms.add(rname)
+                self.flush()
+                self.chrom = rname
+                if self.verbose:
+                    print('New Chrom Started:', self.chrom, sep='\t', file=sys.stderr)
+
+            # Look up the UMIs on this chromosome that couldn't be packed
+            segment_umis = umi_index[start:end]
+            umi_ids = umi_codes
+            if unpacked.any():
+                umi_ids = umi_codes.copy()
+                for umi_number in np.unique(segment_umis[unpacked[segment_umis]]).tolist():
+                    umi_ids[umi_number] = self.get_umi_id(unique_umis[umi_number].decode())
+
+            self.add_segment(read_lines[start:end], umi_ids[segment_umis], strand[start:end], five_prime[start:end],
+                read_quality[start:end])
+
+    def add_segment(self, read_lines, umi_id, strand, five_prime, read_quality):
+        """Dedup a run of reads that are all on the current chromosome"""
+        # Only keep the reads with UMIs that passed
+        read_index = np.flatnonzero(umi_id != -1)
+        if len(read_index) == 0:
+            return
+        read_keys = (umi_id[read_index] << UMI_SHIFT) | (strand[read_index].astype(np.int64) << STRAND_SHIFT) | \
+            (five_prime[read_index] + POSITION_BIAS)
+        read_quality = read_quality[read_index]
+
+        # Find the keys that already have a kept read. These are put in front of the chunk as if they were the first reads seen.
+        if len(self.keys):
+            found = np.minimum(np.searchsorted(self.keys, read_keys), len(self.keys) - 1)
+            in_kept = np.unique(found[self.keys[found] == read_keys])
+        else:
+            in_kept = np.empty(0, dtype=np.int64)
+
+        all_keys = np.concatenate((self.keys[in_kept], read_keys))
+        all_quality = np.concatenate((self.key_quality[in_kept], read_quality))
+        # Kept entries get an order of -1 so they sort in front of the reads from this chunk
+        all_order = np.concatenate((np.full(len(in_kept), -1, dtype=np.int64), np.arange(len(read_index), dtype=np.int64)))
+
+        # Group the reads by key, keeping them in the order they were seen inside of each group
+        sort_order = np.lexsort((all_order, all_keys))
+        sorted_keys = all_keys[sort_order]
+        group_start = np.ones(len(sorted_keys), dtype=bool)
+        group_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        group_id = np.cumsum(group_start) - 1
+
+        # A read replaces the one being kept only if its quality is strictly better than every read before it in the group.
+        # Ranking the qualities lets the group and the quality be packed into one integer for a running max.
+        if self.quality:
+            quality_rank = np.unique(all_quality[sort_order], return_inverse=True)[1].reshape(-1)
+        else:
+            quality_rank = np.zeros(len(sort_order), dtype=np.int64)
+        packed = group_id * (quality_rank.max() + 1) + quality_rank
+        running_max = np.maximum.accumulate(packed)
+        new_best = group_start.copy()
+        new_best[1:] |= packed[1:] > running_max[:-1]
+
+        # The read being kept at each point in the group
+        best_position = np.maximum.accumulate(np.where(new_best, np.arange(len(sort_order)), 0))
+
+        # Every read that isn't first in its group makes a duplicate. If it is better then the read it replaces is the duplicate.
+        if self.duplicate_file != None:
+            duplicate_events = np.flatnonzero(~group_start)
+            previous_best = best_position[duplicate_events - 1]
+            duplicate_source = np.where(new_best[duplicate_events], previous_best, duplicate_events)
+            event_order = np.argsort(all_order[sort_order[duplicate_events]], kind='stable')
+            for position in sort_order[duplicate_source[event_order]].tolist():
+                self.duplicate_file.write(self.get_line(position, in_kept, read_index, read_lines))
+
+        # The read that is kept for each group is the best one at the end of the group
+        group_end = np.flatnonzero(np.append(group_start[1:], True))
+        winners = sort_order[best_position[group_end]]
+        group_keys = sorted_keys[group_end]
+        group_first = sort_order[group_start]
+
+        # Update the groups that already had a kept read
+        existing = group_first < len(in_kept)
+        for group, winner in zip(np.flatnonzero(existing).tolist(), winners[existing].tolist()):
+            if winner >= len(in_kept):
+                kept_position = in_kept[group_first[group]]
+                self.kept_lines[self.key_slot[kept_position]] = read_lines[read_index[winner - len(in_kept)]]
+                self.key_quality[kept_position] = all_quality[winner]
+
+        # Add the new keys in the order they were first seen
+        new_groups = np.flatnonzero(~existing)
+        new_groups = new_groups[np.argsort(all_order[group_first[new_groups]], kind='stable')]
+        new_slots = np.arange(len(self.kept_lines), len(self.kept_lines) + len(new_groups), dtype=np.int64)
+        self.kept_lines += [read_lines[line_number] for line_number in read_index[winners[new_groups] - len(in_kept)].tolist()]
+
+        # Put the new keys into the sorted arrays
+        new_keys = group_keys[new_groups]
+        insert_order = np.argsort(new_keys)
+        insert_at = np.searchsorted(self.keys, new_keys[insert_order])
+        self.keys = np.insert(self.keys, insert_at, new_keys[insert_order])
+        self.key_quality = np.insert(self.key_quality, insert_at, all_quality[winners[new_groups]][insert_order])
+        self.key_slot = np.insert(self.key_slot, insert_at, new_slots[insert_order])
+
+    def get_line(self, position, in_kept, read_index, read_lines) -> str:
+        """Find the line for a position in the combined kept + chunk arrays"""
+        if position < len(in_kept):
+            return self.kept_lines[self.key_slot[in_kept[position]]]
+        return read_lines[read_index[position - len(in_kept)]]
@@ -0,0 +1,168 @@
+"""
+Paired end version of the dedup logic. The duplicate key of a pair is the UMI plus the strand and clip adjusted 5' position
+of both mates, and both mates are always kept or thrown out together. The first mate that is seen waits in a buffer keyed
+by QNAME until its mate shows up. Since the file is sorted by position, a mate can only still show up while the current
+position hasn't passed the mate position (PNEXT) of the read that is waiting. Reads are taken out of the buffer once that
+happens, so the buffer only ever holds the reads that span the current position instead of growing with the chromosome.
+
+Each read is stored with its own line and its number in the input, so the kept reads are written out in the same order they
+were read in and a coordinate sorted file stays sorted. Only the choice of which reads to keep is made for both mates at once.
+
+Reads that never get a mate on the same chromosome (single reads, unmapped mates, mates on another chromosome, or mates that
+were filtered out) along with secondary and supplementary alignments are deduped on their own, the same as single end reads.
+"""
+
+import heapq
+import sys
+
+import cigar_offsets
+import external_sort
+import umi_keys
+
+
+# Secondary and supplementary alignments share the QNAME of the primary alignment so they are never paired up
+NOT_PRIMARY_FLAGS = 0x100 | 0x800
+
+
+class PairedDedupEngine:
+    """
+    Holds the mate buffer and the kept pairs for the current chromosome. Kept pairs are stored with the number and line of
+    both mates, and all of the kept reads are written out in the order they were read in when the chromosome changes.
+    """
+
+    def __init__(self, umi_ids, random_umis, quality, output_file, duplicate_file=None, verbose=False):
+        self.umi_ids = umi_ids
+        self.random_umis = random_umis
+        self.quality = quality
+        self.output_file = output_file
+        self.duplicate_file = duplicate_file
+        self.verbose = verbose
+
+        # The chromosome that is being worked on and every one that has been started
+        self.chrom = None
+        self.started_chroms = set()
+
+        # Number of reads seen so far, which puts the kept reads back in input order
+        self.read_number = 0
+
+        # POS of the last read, since the mate buffer is only emptied right if the reads are sorted by POS
+        self.last_position = 0
+
+        # Reads waiting for their mate, QNAME: ((number, line), umi, reverse, 5' position, is the second mate, quality string)
+        self.mate_buffer = dict()
+        # (mate position, QNAME) so the buffer can be cleared out by position
+        self.mate_heap = list()
+
+        # Duplicate key: (((number, line) of each read), mean quality score)
+        self.kept_reads = dict()
+
+    def umi_passes(self, umi: str) -> bool:
+        """Check the UMI the same way as the single end reads"""
+        if self.random_umis:
+            return 'N' not in umi
+        return umi in self.umi_ids
+
+    def add_read(self, read_line: str, line_offset=None):
+        """Dedup one SAM read line. line_offset is not used, it is only taken so this can stand in for the dict engine."""
+        columns = read_line.rstrip('\n').split('\t', 11)
+        qname, flag, rname, pos, cigar, rnext, pnext = \
+            columns[0], int(columns[1]), columns[2], int(columns[3]), columns[5], columns[6], int(columns[7])
+
+        # If it is a new chromosome then write all reads to the file and clear everything out
+        if rname != self.chrom:
+            if rname in self.started_chroms:
+                raise ValueError(external_sort.UNSORTED_MESSAGE.format(rname))
+            self.started_chroms.add(rname)
+            self.flush()
+            self.chrom = rname
+            if self.verbose:
+                print('New Chrom Started:', rname, sep='\t', file=sys.stderr)
+        else:
+            if pos < self.last_position:
+                raise ValueError(external_sort.UNSORTED_POSITION_MESSAGE.format(rname))
+            self.evict_mates(pos)
+        self.last_position = pos
+
+        numbered_read = (self.read_number, read_line)
+        self.read_number += 1
+
+        # Throw out the reads with UMIs that don't pass
+        umi = qname.split(':')[-1]
+        if not self.umi_passes(umi):
+            return
+
+        # Work out the strand and 5' position
+        reverse = (flag & 16) == 16
+        forward_offset, reverse_offset = cigar_offsets.five_prime_offsets(cigar)
+        five_prime = pos + (reverse_offset if reverse else forward_offset)
+        quality_score = columns[10]
+
+        # Reads that won't have a mate on this chromosome are deduped on their own
+        paired = (flag & 1) == 1 and (flag & 8) == 0 and (flag & NOT_PRIMARY_FLAGS) == 0 and rnext in ('=', rname)
+        if not paired:
+            self.check_key(umi_keys.pack_key(umi, reverse, five_prime, self.umi_ids), (numbered_read,), quality_score)
+            return
+
+        # The second mate of the pair to show up pulls the first one out of the buffer
+        if qname in self.mate_buffer:
+            mate_read, mate_umi, mate_reverse, mate_five_prime, mate_is_second, mate_quality = self.mate_buffer.pop(qname)
+
+            # The key always has the first mate in front so it is the same no matter which mate comes first in the file
+            this_mate = (reverse, five_prime)
+            other_mate = (mate_reverse, mate_five_prime)
+            if mate_is_second:
+                this_mate, other_mate = other_mate, this_mate
+            read_key = (umi_keys.pack_key(umi, this_mate[0], this_mate[1], self.umi_ids), other_mate[0], other_mate[1])
+
+            self.check_key(read_key, (mate_read, numbered_read), mate_quality + quality_score)
+
+        # Otherwise wait for the mate
+        else:
+            self.mate_buffer[qname] = (numbered_read, umi, reverse, five_prime, (flag & 128) == 128, quality_score)
+            heapq.heappush(self.mate_heap, (pnext, qname))
+
+    def evict_mates(self, position: int):
+        """Dedup the reads on their own whose mates should have shown up before this position"""
+        while self.mate_heap and self.mate_heap[0][0] < position:
+            mate_position, qname = heapq.heappop(self.mate_heap)
+            self.evict_mate(qname)
+
+    def evict_mate(self, qname: str):
+        """Take a read out of the buffer and dedup it on its own. Reads that already found their mate are skipped."""
+        if qname in self.mate_buffer:
+            numbered_read, umi, reverse, five_prime, is_second, quality_score = self.mate_buffer.pop(qname)
+            self.check_key(umi_keys.pack_key(umi, reverse, five_prime, self.umi_ids), (numbered_read,), quality_score)
+
+    def check_key(self, read_key, numbered_reads, quality_score: str):
+        """
+        Store the (number, line) of the read or both mates if its key is new. Otherwise it is a duplicate, and with quality
+        turned on it replaces the kept one only if its mean quality score is strictly better.
+        """
+        if self.quality:
+            read_score = (sum(quality_score.encode()) - 33 * len(quality_score)) / len(quality_score)
+        else:
+            read_score = None
+
+        if read_key not in self.kept_reads:
+            self.kept_reads[read_key] = (numbered_reads, read_score)
+            return
+
+        if self.quality and read_score > self.kept_reads[read_key][1]:
+            numbered_reads, self.kept_reads[read_key] = self.kept_reads[read_key][0], (numbered_reads, read_score)
+
+        if self.duplicate_file != None:
+            for read_number, read_line in numbered_reads:
+                self.duplicate_file.write(read_line)
+
+    def flush(self):
+        """Dedup every read left in the buffer on its own, then write out every kept read and clear everything out"""
+        for qname in list(self.mate_buffer):
+            self.evict_mate(qname)
+        self.mate_heap = list()
+
+        # Put the kept reads back in the order they were read in
+        kept_reads = [numbered_read for numbered_reads, read_score in self.kept_reads.values() for numbered_read in numbered_reads]
+        kept_reads.sort()
+        for read_number, read_line in kept_reads:
+            self.output_file.write(read_line)
+        self.kept_reads = dict()
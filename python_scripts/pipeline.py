@@ -0,0 +1,109 @@
+"""
+Reader and writer threads that let the disk reads and writes overlap with the dedup work. The reader thread pulls batches
+of lines from the input ahead of the dedup loop, and the writer thread drains batches of output lines to the file. The
+threads are connected to the dedup loop by bounded queues, so only a fixed number of batches are ever held in memory.
+"""
+
+import queue
+import threading
+
+
+# Number of lines that go into each batch
+BATCH_LINES = 10000
+
+# Most batches that can wait in each queue
+MAX_BATCHES = 16
+
+# Marks the end of the lines in a queue
+END_OF_BATCHES = None
+
+
+class PipelineError:
+    """Holds an exception from the reader thread so it can be raised again in the dedup loop"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_ahead(sam_lines, batch_lines=BATCH_LINES, max_batches=MAX_BATCHES):
+    """
+    Read the lines in a separate thread and hand them back in the same order. The reader stays at most max_batches batches
+    ahead of whoever is using the lines.
+    """
+    batch_queue = queue.Queue(maxsize=max_batches)
+
+    def reader():
+        try:
+            batch = list()
+            for sam_line in sam_lines:
+                batch.append(sam_line)
+                if len(batch) >= batch_lines:
+                    batch_queue.put(batch)
+                    batch = list()
+            if batch:
+                batch_queue.put(batch)
+            batch_queue.put(END_OF_BATCHES)
+        except Exception as error:
+            batch_queue.put(PipelineError(error))
+
+    # The thread is a daemon so that it doesn't hold the program open if the dedup loop stops early
+    threading.Thread(target=reader, daemon=True).start()
+
+    while True:
+        batch = batch_queue.get()
+        if batch is END_OF_BATCHES:
+            return
+        if isinstance(batch, PipelineError):
+            raise batch.error
+        yield from batch
+
+
+class QueuedWriter:
+    """
+    File like object that collects the lines written to it into batches and hands them to a writer thread, which writes them
+    to the real file. Closing this waits for everything to be written and then closes the real file.
+    """
+
+    def __init__(self, output_file, batch_lines=BATCH_LINES, max_batches=MAX_BATCHES):
+        self.output_file = output_file
+        self.name = output_file.name
+        self.batch_lines = batch_lines
+        self.batch = list()
+        self.batch_queue = queue.Queue(maxsize=max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def writer(self):
+        """Write out each batch as it comes in"""
+        while True:
+            batch = self.batch_queue.get()
+            if batch is END_OF_BATCHES:
+                return
+            try:
+                self.output_file.write(''.join(batch))
+            except Exception as error:
+                # Hold on to the error for the dedup loop and keep draining so it never gets stuck on a full queue
+                self.error = error
+
+    def send_batch(self):
+        """Hand the current batch to the writer thread"""
+        if self.error != None:
+            raise self.error
+        self.batch_queue.put(self.batch)
+        self.batch = list()
+
+    def write(self, text):
+        self.batch.append(text)
+        if len(self.batch) >= self.batch_lines:
+            self.send_batch()
+        return len(text)
+
+    def close(self):
+        if self.batch:
+            self.send_batch()
+        self.batch_queue.put(END_OF_BATCHES)
+        self.thread.join()
+        self.output_file.close()
+        if self.error != None:
+            raise self.error
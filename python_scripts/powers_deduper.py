@@ -1,392 +1,1005 @@
 import argparse
-import random
-import numpy as np
+import itertools
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
 import re
 
+import bam_io
+import batch
+import checkpoint
+import deduper_api
+import dict_engine
+import external_sort
+import mmap_engine
+import paired_engine
+import pipeline
+import regions
+import run_stats
+import sam_scanner
+import shards
+import umi_whitelist
+
+
+# The counters and timers for --stats, which are only made if it is given
+stats = None
+
+# The checkpoint being resumed from with --resume
+resume_state = None
+
 
 # Import in the sam file that is sorted
 def get_args():
     parser = argparse.ArgumentParser(description='Pass in the sorted SAM file, if paired reads, and a file containing the umis')
-    parser.add_argument('-f', '--file', help='Upload a sorted by chromosome and position SAM file', required=True, type=str)
-    parser.add_argument('-p', '--paired', help='Pass True or False for if they are paired or not. Default=False', default=False, type=bool)
+    parser.add_argument('-f', '--file', help='Upload a sorted by chromosome and position SAM file. BAM files and BGZF compressed \
+        SAM files are also accepted and are found automatically. Pass - to read from stdin. Either this or -m is needed', default=None, \
+        type=str)
+    parser.add_argument('-m', '--manifest', help='Tab separated file with one SAM file per line, optionally followed by its output \
+        path and duplicate file name. Every file is deduped in a shared pool of -t worker processes and a summary of each file \
+        is printed at the end. Default=None', default=None, type=str)
+    parser.add_argument('-o', '--output', help='Path to write the deduped reads to. Pass - to write to stdout. \
+        Default=output/{name of -f}_deduped.sam, or stdout when -f is -', default=None, type=str)
+    parser.add_argument('-p', '--paired', help='Pass True or False for if they are paired or not. Paired reads are deduped on the UMI and \
+        the strand and 5 prime position of both mates, and both mates are kept or thrown out together. Default=False', default=False, type=bool)
     parser.add_argument('-u', '--umi', help='Specify path to UMI file that is separated by newlines. If no UMI file is given then \
         default=random and the program will assume that UMIs are unknown and will generate their own from the reads.', default='random', type=str)
+    parser.add_argument('-lw', '--learn_whitelist', help='Set to True to learn a UMI whitelist when there is no UMI file. Reads are \
+        sampled from evenly spaced points of the file, their UMIs are counted, and the UMIs above the knee of the counts are \
+        written to output/{name of -f}_umi_whitelist.txt and used the same as a UMI file. Only works with a plain SAM file as \
+        input. Default=False', default=False, type=bool)
+    parser.add_argument('-ls', '--learn_samples', help='Number of reads to sample to learn the UMI whitelist with -lw. \
+        Default=100000', default=100000, type=int)
     parser.add_argument('-ds', '--store_duplicates', help='Specify if you would like duplicates returned to a separate file. \
         Set to True. Default=False. If set True, you must specify output file name with argument -do', default=False, type=bool)
     parser.add_argument('-do', '--duplicate_output', help='Specify the file name that the duplicates should be written to.', default=None, type=str)
     parser.add_argument('-q', '--quality', help='Set to True if you want to have the best quality read returned instead \
         of the first duplicate. Default=False', default=False, type=bool)
+    parser.add_argument('-t', '--threads', help='Number of worker processes to use. Each chromosome is deduped in its own process \
+        and the outputs are stitched back together in @SQ order. Default=1', default=1, type=int)
+    parser.add_argument('-w', '--window', help='Largest number of bases that can be soft clipped off the 5\' end of a read. When set, \
+        reads whose 5\' position is more than this many bases behind the current position are written out and freed, so memory \
+        depends on coverage instead of chromosome length. Default=None, which keeps every read until the chromosome changes', default=None, type=int)
+    parser.add_argument('-of', '--output_format', help='Format to write the output (and duplicates) in. sam is plain text, bam is BAM, \
+        and bgzf is BGZF compressed SAM text. Default=sam', default='sam', choices=['sam', 'bam', 'bgzf'], type=str)
+    parser.add_argument('-bt', '--bgzf_threads', help='Number of threads used to compress and decompress BAM/BGZF blocks. Default=4', \
+        default=4, type=int)
+    parser.add_argument('-os', '--offset_storage', help='Set to True to only keep the byte offset and length of each kept read \
+        instead of the whole line. The kept reads are sliced back out of a memory map of the input when they are written. \
+        Only works with plain SAM input. Default=False', default=False, type=bool)
+    parser.add_argument('-st', '--streaming', help='Set to True to write each read out as soon as it is first seen and only keep \
+        its key. The output is the same, but it comes out while the file is still being read and uses less memory. Can not be \
+        used with -q. Default=False', default=False, type=bool)
+    parser.add_argument('-pl', '--pipeline', help='Set to True to read the input and write the output in their own threads, \
+        connected to the dedup work by bounded queues, so that disk reads and writes overlap with the deduping. Only helps when \
+        the reads and writes wait on slow storage, and is slower when the file is on a local disk. Default=False', \
+        default=False, type=bool)
+    parser.add_argument('-e', '--engine', help='Which engine to dedup with. dict checks one read at a time against a dictionary, \
+        numpy works on large chunks of reads at a time with vectorized NumPy code, and mmap scans the bytes of a memory mapped \
+        SAM file without decoding the lines (the same as dict with -os). Default=dict', \
+        default='dict', choices=['dict', 'numpy', 'mmap'], type=str)
+    parser.add_argument('-cs', '--chunk_size', help='Number of reads the numpy engine works on at a time. Default=10000', \
+        default=10000, type=int)
+    parser.add_argument('-ec', '--error_correct', help='Largest Hamming distance a UMI can be from a known UMI and still be corrected \
+        to it. UMIs that are this close to more than one known UMI are still thrown out. Only works with a UMI file. Default=0', \
+        default=0, type=int)
+    parser.add_argument('-dc', '--directional', help='Set to True to cluster random UMIs at the same strand and 5 prime position \
+        that are one mismatch apart, keeping only one read for each cluster. Default=False', default=False, type=bool)
+    parser.add_argument('-dr', '--directional_ratio', help='A UMI is only clustered into a UMI it is one mismatch away from if \
+        that UMI has at least this many times its reads, minus one. Default=2', default=2.0, type=float)
+    parser.add_argument('-sj', '--stats', help='Path to write a JSON file of run statistics to: the read, unique, duplicate and \
+        discarded UMI counts and the largest dictionary size for each chromosome, the time spent parsing, in add_cigar_to_pos, in \
+        dictionary lookups and in output writes, and the reads per second and peak memory. Only works with the dict engine \
+        and single end reads. Default=None', default=None, type=str)
+    parser.add_argument('-so', '--sort', help='Set to True if the input is not sorted. The reads are sorted by chromosome and 5 prime \
+        position with a disk backed merge sort and handed straight to the dedup. Default=False', default=False, type=bool)
+    parser.add_argument('-sm', '--sort_memory', help='Megabytes of reads to hold in memory at once while sorting before a sorted \
+        run is written to disk. Default=1024', default=1024, type=int)
+    parser.add_argument('-mm', '--max_memory', help='Megabytes of reads the dictionary can hold before it is sorted and spilled to \
+        disk. The spilled runs are merged when the chromosome is finished, so very deep chromosomes finish instead of running out \
+        of memory while the rest stay in memory. Can be a fraction, like 0.5. Default=None, which never spills', default=None, type=float)
+    parser.add_argument('-ck', '--checkpoint', help='Path to write a checkpoint to every time the chromosome changes, so a job that \
+        is stopped can be picked up again with --resume. It is removed once the run finishes. Default=None', default=None, type=str)
+    parser.add_argument('-re', '--resume', help='Set to True to pick up from the checkpoint given to -ck. The outputs are cut back to \
+        where they were at the checkpoint and the input is read from there. If there is no checkpoint yet the run starts from the \
+        beginning. Default=False', default=False, type=bool)
+    parser.add_argument('-sh', '--shard', help='Only dedup shard i of N, given as i/N with i from 1 to N, so the chromosomes can \
+        be split across separate jobs. The chromosomes are given out by bytes using the index from shards.py index if there is \
+        one. The output is named with the shard and a .shard.json file is written next to it for shards.py merge. Default=None', \
+        default=None, type=str)
+    parser.add_argument('-rg', '--regions', help='BED file of target regions. Only the reads with a POS inside a region are \
+        deduped and written, and the rest of the file is skipped by seeking with the index from shards.py index, which is \
+        made the first time if there is not one yet. Default=None', default=None, type=str)
+    parser.add_argument('-rm', '--region_margin', help='Number of bases the regions are widened by on both sides for -rg, so every \
+        read with the same 5 prime position as a read in a region is seen. It has to cover the reference span plus soft \
+        clipping of the longest read. Default=1000', default=1000, type=int)
 
     return parser.parse_args()
 
-# Load argparse info into a variable
-args = get_args()
-
-# Check ds and do arguments
-if args.store_duplicates == True:
-    if args.duplicate_output == None:
-        raise ValueError('You did not specify an output for the duplicates. Please use -do and specify and output')
-
-# Check paired arguments
-if args.paired == True:
-    raise ValueError('This has not been implemented yet. Coming soon. Please dont specify True.')
+def check_args(args):
+    """Check that the combination of arguments that was passed in makes sense before any work is done"""
+    # Either one file or a manifest of files
+    if (args.file == None) == (args.manifest == None):
+        raise ValueError('Please pass either one SAM file with -f or a manifest of SAM files with -m')
+
+    # Every file in the manifest is checked the same way it would be on its own
+    if args.manifest != None:
+        if args.threads < 1:
+            raise ValueError('You must use at least one thread. Please pass a number of 1 or greater to -t')
+        if args.output != None or args.checkpoint != None or args.resume == True or args.stats != None or args.shard != None or \
+            args.regions != None:
+            raise ValueError('-m takes the outputs from the manifest so it can not be used with -o, and -ck, --resume, --stats, -sh and \
+-rg only work on a single file. Please leave those out')
+        # Each file is checked on its own when it is run, so one bad file fails in the summary instead of stopping the batch
+        return
+
+    # Check ds and do arguments
+    if args.store_duplicates == True:
+        if args.duplicate_output == None:
+            raise ValueError('You did not specify an output for the duplicates. Please use -do and specify and output')
+
+    # Check paired arguments
+    if args.paired == True:
+        if args.engine != 'dict':
+            raise ValueError('-p only works with the dict engine. Please use -e dict or leave out -p')
+        if args.offset_storage == True or args.streaming == True or args.window != None or args.directional == True:
+            raise ValueError('-p keeps its own buffer of mates so it can not be used with -os, -st, -w or -dc. Please leave those out')
+
+    # Check the threads argument
+    if args.threads < 1:
+        raise ValueError('You must use at least one thread. Please pass a number of 1 or greater to -t')
+
+    # Check the BGZF threads argument
+    if args.bgzf_threads < 1:
+        raise ValueError('You must use at least one BGZF thread. Please pass a number of 1 or greater to -bt')
+
+    # Some options seek around in or memory map the input, which only works for plain SAM files and not stdin
+    plain_sam = args.file != '-' and not bam_io.is_bgzf(args.file)
+
+    # The chromosomes are split up by their byte offsets
+    if args.threads > 1 and not plain_sam:
+        raise ValueError('-t can only be used with a plain SAM file as input. Please convert the BAM to SAM or run with one thread.')
+
+    # Check the window argument
+    if args.window != None and args.window < 0:
+        raise ValueError('The window can not be negative. Please pass a number of 0 or greater to -w')
+
+    # Streaming keeps the first read, so it can't be used to find the best quality read
+    if args.streaming == True:
+        if args.quality == True:
+            raise ValueError('-st always keeps the first read so it can not be used with -q. Please leave out one of them')
+        if args.engine != 'dict' or args.offset_storage == True:
+            raise ValueError('-st only works with the dict engine and without -os. Please use -e dict or leave out -st')
+
+    # Check the UMI correction arguments
+    if args.error_correct < 0:
+        raise ValueError('The UMI correction distance can not be negative. Please pass a number of 0 or greater to -ec')
+    if args.error_correct > 0 and args.umi == 'random' and args.learn_whitelist != True:
+        raise ValueError('-ec corrects UMIs to the known UMIs so it needs a UMI file or -lw. Please pass one with -u or leave out -ec')
+
+    # The whitelist is learned by seeking around in the input, and it is used in place of a UMI file
+    if args.learn_whitelist == True:
+        if args.umi != 'random':
+            raise ValueError('-lw learns the UMIs when there is no UMI file. Please leave out -u or leave out -lw')
+        if not plain_sam:
+            raise ValueError('-lw can only be used with a plain SAM file as input. Please convert the BAM to SAM or leave out -lw')
+        if args.directional == True:
+            raise ValueError('-dc only works with random UMIs so it can not be used with -lw. Please leave out one of them')
+        if args.learn_samples < 1:
+            raise ValueError('The number of reads to sample must be at least 1. Please pass a number of 1 or greater to -ls')
+
+    # Directional clustering is done on the dictionary when the chromosome is finished
+    if args.directional == True:
+        if args.umi != 'random':
+            raise ValueError('-dc only works with random UMIs. Please leave out -u or leave out -dc')
+        if args.engine != 'dict' or args.streaming == True or args.window != None:
+            raise ValueError('-dc needs the whole chromosome in the dictionary so it only works with the dict engine and without \
+-st or -w. Please leave those out or leave out -dc')
+
+    # The stats come from the dict engine functions
+    if args.stats != None and (args.engine != 'dict' or args.paired == True):
+        raise ValueError('--stats only works with the dict engine and single end reads. Please use -e dict or leave out --stats')
+
+    # The spilled runs hold whole lines for each key and are only merged at the end of the chromosome
+    if args.max_memory != None:
+        if args.max_memory <= 0:
+            raise ValueError('The memory budget must be more than 0. Please pass a number greater than 0 to -mm')
+        if args.engine != 'dict' or args.paired == True:
+            raise ValueError('-mm only works with the dict engine and single end reads. Please use -e dict or leave out -mm')
+        if args.offset_storage == True or args.streaming == True or args.window != None or args.directional == True:
+            raise ValueError('-mm can not be used with -os, -st, -w or -dc, which already keep less in the dictionary or need all \
+of it at once. Please leave those out')
+
+    # The sorted reads are handed straight to the dedup so there is no sorted file to split or slice
+    if args.sort == True:
+        if args.threads > 1 or args.offset_storage == True or args.engine == 'mmap':
+            raise ValueError('-so hands the sorted reads straight to the dedup, so it can not be used with -t, -os or -e mmap')
+        if args.sort_memory < 1:
+            raise ValueError('The sort memory must be at least 1. Please pass a number of 1 or greater to -sm')
+
+    # The checkpoint is the byte offset into a plain SAM input and the lengths of plain SAM outputs
+    if args.resume == True and args.checkpoint == None:
+        raise ValueError('--resume needs the checkpoint to pick up from. Please pass its path to -ck')
+    if args.checkpoint != None:
+        if not plain_sam or args.output == '-' or args.output_format != 'sam':
+            raise ValueError('-ck needs a plain SAM file as input and plain SAM files as output, not stdin or stdout')
+        if args.engine != 'dict' or args.paired == True or args.threads > 1 or args.sort == True or args.pipeline == True:
+            raise ValueError('-ck only works with the dict engine on single end reads, and not with -t, -so or -pl')
+
+    # Each shard seeks to its chromosomes in the input, and merge copies byte ranges out of the plain SAM outputs
+    if args.shard != None:
+        shards.parse_shard(args.shard)
+        if not plain_sam or args.output == '-' or args.output_format != 'sam':
+            raise ValueError('-sh needs a plain SAM file as input and a plain SAM file as output, not stdin or stdout')
+        if args.sort == True or args.checkpoint != None:
+            raise ValueError('-sh can not be used with -so or -ck. Please leave those out')
+
+    # Each region is read by seeking to it in the input and deduped on its own with the dict engine
+    if args.regions != None:
+        if not plain_sam:
+            raise ValueError('-rg can only be used with a plain SAM file as input. Please convert the BAM to SAM or leave out -rg')
+        if args.engine != 'dict' or args.paired == True:
+            raise ValueError('-rg only works with the dict engine and single end reads. Please use -e dict or leave out -rg')
+        if args.threads > 1 or args.shard != None or args.sort == True or args.checkpoint != None or args.offset_storage == True or \
+            args.pipeline == True or args.stats != None:
+            raise ValueError('-rg can not be used with -t, -sh, -so, -ck, -os, -pl or --stats. Please leave those out')
+        if args.region_margin < 0:
+            raise ValueError('The region margin can not be negative. Please pass a number of 0 or greater to -rm')
+
+    # Check the engine arguments
+    if args.chunk_size < 1:
+        raise ValueError('The chunk size must be at least 1. Please pass a number of 1 or greater to -cs')
+    if args.engine != 'dict' and args.window != None:
+        raise ValueError('-w only works with the dict engine. Please use -e dict or leave out -w')
+    if args.engine == 'mmap' and not plain_sam:
+        raise ValueError('-e mmap can only be used with a plain SAM file as input. Please convert the BAM to SAM or use another engine')
+
+    # The kept reads are sliced out of the input file so it has to be plain SAM
+    if args.offset_storage == True:
+        if args.engine != 'dict':
+            raise ValueError('-os only works with the dict engine. Please use -e dict or leave out -os')
+        if not plain_sam:
+            raise ValueError('-os can only be used with a plain SAM file as input. Please convert the BAM to SAM or leave out -os')
 
 ################################################### Function Section
 
-def get_important_information(read_file_line: str): 
+def get_shard_name():
+    """The shard that is added to the names of the files this run writes with -sh, so the shards don't write over each other"""
+    if args.shard != None:
+        shard, shard_count = shards.parse_shard(args.shard)
+        return f'_shard{shard}of{shard_count}'
+    else:
+        return ''
+
+def learn_umi_whitelist():
     """
-    This function takes in a SAM file line and spits out the important information for that is needed so you can check
-    to see if that read is a duplicate or not.
+    Learn the UMI whitelist for -lw from a sample of the input and write it next to the outputs. The run then goes on the same
+    as if the whitelist had been passed to -u, so the UMIs are loaded from it the same way. If the sampled counts have no knee
+    then no whitelist is written and the run goes on with random UMIs, the same as without -lw.
     """
-    # Split the line into a list
-    full_line = read_file_line.strip('\n').split('\t')
+    whitelist, seen_umis, covered = umi_whitelist.learn_whitelist(args.file, args.learn_samples)
 
-    # store important variables that are needed to check
-    qname, flag, rname, pos, cigar, quality_score = full_line[0], full_line[1], full_line[2], full_line[3], full_line[5], full_line[10]
+    # Every UMI looks real so nothing is thrown out, and there are no known UMIs to correct to with -ec
+    if whitelist == None:
+        print('No UMI Whitelist Knee Found:', f'keeping all {seen_umis} sampled UMIs as random UMIs', sep='\t', file=sys.stderr)
+        return deduper_api.load_umis('random')
 
-    # pull out the umi from the qname
-    umi_qname = qname.split(':')[-1]
+    input_name = re.sub(r'\.sam$', '', args.file).split('/')[-1]
+    whitelist_path = f'output/{input_name}_umi_whitelist{get_shard_name()}.txt'
+    umi_whitelist.write_whitelist(whitelist, whitelist_path)
+    print('UMI Whitelist Learned:', f'{len(whitelist)} of {seen_umis} sampled UMIs', f'{covered:.1%} of sampled reads',
+        whitelist_path, sep='\t', file=sys.stderr)
 
-    # return the strand from the flag
-    strand = check_strand(flag)
-    
-    return read_file_line, umi_qname, strand, rname, pos, cigar, quality_score
+    args.umi = whitelist_path
+    return deduper_api.load_umis(args.umi, args.error_correct)
 
-def add_cigar_to_pos(cigar_variable, position, strand):
+def get_output_paths(extension):
     """
-    Add the soft clipped ends to the beginning of the start position. This will be used for comparison with the positions in the 
-    UMI dict
-    If the strand is forward then it would subtract the soft clipped end to the 5' of the forward start position.
-    If the strand is reverse then it would add the soft clipped end to the 5' of the reverse start position.
+    Work out the output path, and the duplicate path if -ds is set. The output is named after the input unless one was given,
+    and goes to stdout when the input is stdin since there is no name to give it. With -sh the shard is added to the names so
+    the shards don't write over each other.
     """
-    # Check to see if there is an S in the cigar_variable
-    soft_clipping = 'S' in cigar_variable
-    
-    # If there is soft clipping then do this
-    if soft_clipping:
+    shard_name = get_shard_name()
 
-        # First break up the line:
-        split_cigar = re.findall('\d+[A-Z]{1}', cigar_variable)
-
-        # Then we check the orientation of the read
-        if strand == 'forward':
-            
-            # If S is in the first position then we need to subtract it
-            if 'S' in split_cigar[0]:
+    if args.output != None:
+        output_path = args.output
+    elif args.file == '-':
+        output_path = '-'
+    else:
+        output_name = re.sub(r'\.sam\.gz$|\.sam$|\.bam$', '', args.file).split('/')[-1]
+        output_path = f'output/{output_name}_deduped{shard_name}.{extension}'
 
-                # first get the amount that was soft clipped off
-                cigar_clipped = cigar_variable.split('S')[0]
+    if args.store_duplicates == True:
+        duplicate_path = f'output/duplicates/{args.duplicate_output}{shard_name}.{extension}'
+    else:
+        duplicate_path = None
 
-                # Now calculate the new position for the forward strand
-                new_pos = int(position) - int(cigar_clipped)
+    return output_path, duplicate_path
 
-            else:
-                # Just return position as we don't care about soft clipping at the end of the read for forward strands
-                new_pos = position
-        # This means it is the reverse strand so we add the soft clipped ends back on
-        else:
-            
-            # instantiate a sum
-            sum = 0
-
-            # First we have to remove the first S if it is in it.
-            if 'S' in split_cigar[0]:
-                # Remove that item the S
-                split_cigar.remove(split_cigar[0])
-
-                # Iter through the elements in the list and add them all up so I know how much to add
-                for elem in split_cigar:
-                    if 'I' in elem:
-                        next
-                    else:
-                        sum += int(re.sub('[A-Z]', '', elem))
-            
-            # If the first elem isnt an S then we just go through the same logic as above.
-            else:
-                for elem in split_cigar:
-                    if 'I' in elem:
-                        next
-                    else:
-                        sum += int(re.sub('[A-Z]', '', elem))
-            
+def save_checkpoint(engine, rname, line_offset):
+    """
+    Write a checkpoint for the start of a new chromosome, which is called by the dict engine once the old one is written out.
+    The read that started it has already been parsed and counted in the stats, so the stats for this chromosome are left out,
+    and so is the chromosome itself from the ones that were started.
+    """
+    state = {
+        'input': args.file,
+        'chromosome': rname,
+        'input_offset': line_offset,
+        'output_length': checkpoint.file_length(engine.output_file),
+        'duplicate_length': checkpoint.file_length(engine.duplicate_file) if engine.duplicate_file != None else None,
+        'started_chroms': sorted(engine.started_chroms - {rname}),
+    }
+    if stats != None:
+        state['elapsed_seconds'] = time.perf_counter() - start_time
+        state['stage_seconds'] = stats.stage_seconds
+        state['chromosomes'] = {chrom: counts for chrom, counts in stats.chromosomes.items() if chrom != rname}
+    checkpoint.write_checkpoint(args.checkpoint, state)
+
+def get_sq_order(header_lines) -> dict:
+    """
+    Pull the reference names out of the @SQ header lines so the chromosome outputs can be put back together in the
+    same order as the header.
+    """
+    # Create the dict that will hold the order of each chromosome
+    sq_order = dict()
 
-            new_pos = int(position) + sum
+    for header_line in header_lines:
+        if header_line.startswith('@SQ'):
+            # Find the SN: field which holds the chromosome name
+            for field in header_line.strip('\n').split('\t'):
+                if field.startswith('SN:'):
+                    sq_order[field[3:]] = len(sq_order)
 
-    
-    # If there is no soft clipping present then check what strand
-    else:
-        
-        # If forward spit out the same position
-        if strand == 'forward':
-        
-            new_pos = int(position)
-        # If reverse and no S then just add 101 to the POS to get 5' since POS is left most.
-        else:
-            # First break up the line:
-            split_cigar = re.findall('\d+[A-Z]{1}', cigar_variable)
-
-            sum = 0
-
-            if 'S' in split_cigar[0]:
-                split_cigar.remove(0)
-                for elem in split_cigar:
-                    if 'I' in elem:
-                        next
-                    else:
-                        sum += int(re.sub('[A-Z]', '', elem))
-            else:
-                for elem in split_cigar:
-                    if 'I' in elem:
-                        next
-                    else:
-                        sum += int(re.sub('[A-Z]', '', elem))
-            
-
-            new_pos = int(position) + sum
-
-    
-    return new_pos
-
-def check_strand(bitflag):
-    """Check the bitflag to know if the strand is reversed or not"""
-    if ((int(bitflag) & 16) == 16):
-        return 'reverse'
-    else:
-        return 'forward'
+    return sq_order
 
-def instantiate_umi_set(umi_file: str) -> set:
+def get_rname_at(sam_file, offset):
     """
-    Creates a set of unique umis that will be used for reference to throw out bad UMI reads. If no known UMIs then we will create
-    not create this
+    Return the start of the first read line that begins at or after offset, as well as the chromosome of that read.
+    sam_file needs to be opened in binary mode. If there are no more reads then (file size, None) is returned.
     """
-    # Create the dictionary that will be used
-    temp_set = set()
+    sam_file.seek(offset)
+
+    # If we are not at the beginning of a line then skip over the partial line we landed in
+    if offset > 0:
+        sam_file.seek(offset - 1)
+        sam_file.readline()
+
+    line_start = sam_file.tell()
+    sam_line = sam_file.readline()
 
-    # If umi file isn't set/ no know UMIs
-    if umi_file == 'random':
-        
-        return temp_set
+    # We are at the end of the file
+    if not sam_line:
+        return line_start, None
 
+    return line_start, sam_line.split(b'\t', 3)[2].decode()
+
+def split_sam_by_chromosome(sam_path):
+    """
+    Split the sorted SAM file into byte ranges, one for each chromosome. Since the file is sorted every chromosome is
+    contiguous, so the end of each chromosome is found with a binary search instead of reading the whole file. A chromosome
+    that starts a second range means the file isn't sorted, and each worker checks that its own range only has one.
+    Returns the header lines and a list of (rname, start, end) byte ranges in the order they appear in the file.
+    """
+    header_lines = list()
+    chunks = list()
+    found_rnames = set()
+
+    with open(sam_path, 'rb') as sam_file:
+        # First read through the header lines at the top of the file
+        while True:
+            line_start = sam_file.tell()
+            sam_line = sam_file.readline()
+            if sam_line.startswith(b'@'):
+                header_lines.append(sam_line.decode())
+            else:
+                break
+
+        # Get the file size so we know where to stop
+        file_size = sam_file.seek(0, os.SEEK_END)
+
+        # Find the chromosome of the first read
+        start, rname = get_rname_at(sam_file, line_start)
+
+        while rname != None:
+            # Binary search for the first line that is not on this chromosome. low is always on rname and high never is.
+            low, high = start, file_size
+            while high - low > 1:
+                middle = (low + high) // 2
+                middle_start, middle_rname = get_rname_at(sam_file, middle)
+                if middle_rname == rname:
+                    low = middle
+                else:
+                    high = middle
+
+            # high now sits inside the last line of this chromosome, so the next chromosome starts on the line after it
+            end, next_rname = get_rname_at(sam_file, high)
+            if rname in found_rnames:
+                raise ValueError(external_sort.UNSORTED_MESSAGE.format(rname))
+            found_rnames.add(rname)
+            chunks.append((rname, start, end))
+            start, rname = end, next_rname
+
+    return header_lines, chunks
+
+def read_lines_until(sam_file, end):
+    """Hand back the lines of a SAM file opened in binary mode, starting where it is now and stopping at the byte offset end"""
+    while sam_file.tell() < end:
+        yield sam_file.readline().decode()
+
+def open_input_map(sam_file):
+    """Memory map the input file for -os so that the kept reads can be sliced back out of it"""
+    if args.offset_storage == True:
+        return mmap.mmap(sam_file.fileno(), 0, access=mmap.ACCESS_READ)
     else:
-        # UMi file open and store as a variable
-        with open(umi_file, 'r') as file:
+        return None
 
-            # first read in the lines
-            for umi_line in file:
-                
-                # Make the umis from the file the keys for this dict
-                temp_set.add(umi_line.strip('\n'))
+def set_worker_globals(worker_args, worker_umi_set):
+    """Hand the parsed arguments and the UMI set to each worker process"""
+    global args, umi_created_set
+    args = worker_args
+    umi_created_set = worker_umi_set
 
-    return temp_set
+    # Forked workers already have the stats set up from the main process
+    if args.stats != None and stats == None:
+        install_stats()
 
-def convert_phred(asci_char_str):
-    """Convert the ASCII characters to phred score 33"""
-    return [ord(x) + 33 for x in asci_char_str]
+def install_stats():
+    """Set up the --stats counters and timers, which make_dict_engine hooks into every dict engine"""
+    global stats
+    stats = run_stats.RunStats()
 
+def make_dict_engine(umi_set, output_file, duplicate_file, input_map=None, last_chrom=None):
+    """
+    Make a dict engine from the arguments. With --stats the parsing and 5' position functions of the engine are swapped for
+    timed versions that also count the reads and its dictionary times its lookups, so the dedup logic doesn't change at all.
+    With -ck a checkpoint is written every time the engine starts a new chromosome.
+    """
+    engine = dict_engine.DictDedupEngine(umi_set, args.umi == 'random', args.quality == True, output_file, duplicate_file,
+        window=args.window,
+        streaming=args.streaming == True,
+        directional_ratio=args.directional_ratio if args.directional == True else None,
+        input_map=input_map,
+        storing_dict=stats.make_dict() if stats != None else None,
+        on_new_chrom=save_checkpoint if args.checkpoint != None else None,
+        last_chrom=last_chrom,
+        max_memory=int(args.max_memory * (1 << 20)) if args.max_memory != None else None,
+        spill_dir=get_work_dir(output_file),
+        on_keys_merged=stats.merge_keys if stats != None else None,
+        verbose=True)
+
+    if stats != None:
+        engine.get_important_information = stats.timed_parser(engine.get_important_information)
+        engine.add_cigar_to_pos = stats.timed_cigar(engine.add_cigar_to_pos)
+
+    # Put back the chromosomes that were finished before the checkpoint
+    if resume_state != None:
+        engine.started_chroms.update(resume_state['started_chroms'])
+
+    return engine
+
+def dedup_chromosome(sam_path, rname, start, end, part_dir):
+    """
+    Dedup a single chromosome of the SAM file, which is the byte range from start to end. This is what is run in each worker
+    process. The deduped reads (and duplicates if -ds is set) are written to their own part files inside of part_dir and the
+    names of these part files are returned.
+    """
+    # Create the part files for this chromosome
+    part_output_name = os.path.join(part_dir, f'{start}.sam')
+    part_duplicate_name = os.path.join(part_dir, f'{start}.duplicates.sam')
+    part_output = open(part_output_name, 'w')
+    if args.store_duplicates == True:
+        part_duplicates = open(part_duplicate_name, 'w')
+    else:
+        part_duplicates = None
+
+    # Each chromosome gets its own stats, which are sent back with the part files
+    if stats != None:
+        stats.reset()
+        part_output = run_stats.TimedWriter(part_output, stats)
+        if part_duplicates != None:
+            part_duplicates = run_stats.TimedWriter(part_duplicates, stats)
+
+    # Read until we hit the end of this chromosome
+    with open(sam_path, 'rb') as sam_file:
+        input_map = open_input_map(sam_file)
+        sam_file.seek(start)
+        sam_lines = read_lines_until(sam_file, end)
+
+        if args.engine == 'numpy':
+            run_numpy_engine(sam_lines, part_output, part_duplicates, umi_created_set)
+
+        elif args.paired == True:
+            engine = paired_engine.PairedDedupEngine(umi_created_set, args.umi == 'random', args.quality == True, part_output,
+                part_duplicates, verbose=True)
+            for sam_line in sam_lines:
+                engine.add_read(sam_line)
+            engine.flush()
+
+        elif args.engine == 'mmap':
+            with mmap.mmap(sam_file.fileno(), 0, access=mmap.ACCESS_READ) as chrom_map:
+                engine = mmap_engine.MmapDedupEngine(chrom_map, umi_created_set, args.umi == 'random', args.quality == True,
+                    part_output, part_duplicates, verbose=True)
+                try:
+                    engine.dedup_range(start, end)
+                    engine.flush()
+                finally:
+                    engine.close()
 
-def store_or_check_read_against_dict(read_line, storing_dict, umi_set, output_file, duplicate_file, last_chrom):
-    """Take in a read and checks to see if this read already exists in the dictionary. If it does not then it is stored into the dictionary.
-    This will be the main chunk of code that will be running for our analysis.
+        else:
+            # Each chromosome gets its own engine, which starts out on this chromosome
+            engine = make_dict_engine(umi_created_set, part_output, part_duplicates, input_map, rname)
 
+            # Keep track of where each line starts for -os
+            line_offset = start
+            for sam_line in sam_lines:
+                engine.add_read(sam_line, line_offset)
+                line_offset += dict_engine.byte_length(sam_line)
 
-    dictionary example:
+            # Write out the reads that are left in the dictionary
+            engine.flush()
 
-    dict = {
-        'umi_qname-strand--updated_pos-chrom': (whole read, quality score, chrome)
-        }
-    """
+    part_output.close()
+    if args.store_duplicates == True:
+        part_duplicates.close()
+
+    print('Chrom Finished:', rname, sep='\t', file=sys.stderr)
 
-    # First we break the line into multiple parts
-    full_line, umi_qname, strand, rname, pos, cigar, quality_score = get_important_information(read_line)
+    if stats != None:
+        return part_output_name, part_duplicate_name, stats.to_dict()
+    else:
+        return part_output_name, part_duplicate_name, None
 
-    ################# We need to check what chromosome we are on, if it is a new one then write all reads to the file and clear the dictionary.
+def run_parallel(sam_path, output_file, duplicate_file, umi_set):
+    """
+    Split the SAM file up by chromosome and dedup each chromosome in its own process. Once every chromosome is done the part
+    files are concatenated in the @SQ order of the header. With -sh only the chromosomes of the shard are deduped.
 
-    if last_chrom != rname:
-            # Iter through the dict and write them to the output file
-            for key in storing_dict:
-                output_file.write(storing_dict[key][0])
-            # Clear the dictionary as we are on a new chromosome now
-            storing_dict.clear()
-            print('New Chrom Started:', rname, sep='\t')
+    Returns the stats of every worker added up (None without --stats), and where the header and each chromosome ended up in
+    the output, which is what shards.py merge needs.
+    """
+    # Use the index from shards.py if there is one, otherwise find the chromosomes with a binary search
+    index = shards.read_index(sam_path)
+    if index != None:
+        header_lines, chunks = index
     else:
-        pass
-
-
-################# Dictionary is sorted now we can check/store new entries into/against the dict
-
-    # First we check to see if the umi has any values set
-    if args.umi == 'random':
-        
-        # Look for Ns in the UMI
-        if 'N' not in umi_qname:
-
-            # Update the position if it needs to be changed from soft clipping
-            updated_pos = add_cigar_to_pos(cigar, pos, strand)
-
-            # Create the key needed to be checked and or put into the dict
-            key_string = umi_qname + "-" + strand + "-" + str(updated_pos)
-
-            # Check to see if it is in the dict
-            if key_string in storing_dict:
-                
-                # We need to check to see if the user wants higher quality scores
-                if args.quality == True:
-                    # Check the quality scores against each other
-                    if np.mean(convert_phred(quality_score)) > np.mean(convert_phred(storing_dict[key_string][1])):
-
-                        # check duplicate store option
-                        if args.store_duplicates == True:
-                            duplicate_file.write(storing_dict[key_string][0])
-                        else:
-                            rname
-
-                        # Replace the read with the better quality one.
-                        storing_dict[key_string] = (full_line, quality_score)
-
-                    # The quality is not better so do not overwrite this dict entry
-                    else:
-                        # If the user wants duplicates stored then write to duplicate file
-                        if args.store_duplicates == True:
-                            duplicate_file.write(full_line)
-                            return rname
-                        else:
-                            return rname
-                
-                # If not then don't do anything as we already have this entry present, but check stored_duplicate arg first
-                else:
-                    if args.store_duplicates == True:
-                        duplicate_file.write(full_line)
-                        return rname
-                    else:
-                        return rname
-            
-            # There is no entry in the dict yet, this is a new read. We have to add it.        
-            else:
-                storing_dict[key_string] = (full_line, quality_score)
-                return rname
+        header_lines, chunks = split_sam_by_chromosome(sam_path)
 
-        # If it isn't then throw it out.
-        else:
-            return rname
+    if args.shard != None:
+        chunks = shards.shard_chunks(chunks, *shards.parse_shard(args.shard))
+
+    # Write all of the header lines to the output file already. A BAM file of duplicates also needs the header.
+    for header_line in header_lines:
+        output_file.write(header_line)
+        if duplicate_file != None and args.output_format == 'bam':
+            duplicate_file.write(header_line)
 
+    # Put the chromosomes into @SQ order. Chromosomes not in the header go at the end in the order they were found.
+    sq_order = get_sq_order(header_lines)
+    chunks = sorted(chunks, key=lambda chunk: sq_order.get(chunk[0], len(sq_order)))
 
-    # We have known UMIs we will follow this logic 
+    # The parts are stored next to the output so that we don't fill up /tmp. If we are writing to stdout then use the temp folder.
+    if isinstance(output_file.name, str):
+        part_dir = tempfile.mkdtemp(prefix='deduper_parts_', dir=os.path.dirname(output_file.name))
     else:
-        # Check to see if the umi is in the set
-        if umi_qname in umi_set:
-            
-            # Update the position if it needs to be changed from soft clipping
-            updated_pos = add_cigar_to_pos(cigar, pos, strand)
-
-            # Create the key needed to be checked and or put into the dict
-            key_string = umi_qname + "-" + strand + "-" + str(updated_pos)
-
-            # Check to see if it is in the dict
-            if key_string in storing_dict:
-                
-                # We need to check to see if the user wants higher quality scores
-                if args.quality == True:
-                    # Check the quality scores against each other
-                    if np.mean(convert_phred(quality_score)) > np.mean(convert_phred(storing_dict[key_string][1])):
-
-                        # check duplicate store option
-                        if args.store_duplicates == True:
-                            duplicate_file.write(storing_dict[key_string][0])
-                        else:
-                            None
-
-                        # Replace the read with the better quality one.
-                        storing_dict[key_string] = (full_line, quality_score)
-
-                    # The quality is not better so do not overwrite this dict entry
-                    else:
-                        # If the user wants duplicates stored then write to duplicate file
-                        if args.store_duplicates == True:
-                            duplicate_file.write(full_line)
-                            return rname
-                        else:
-                            return rname
-                
-                # If not then don't do anything as we already have this entry present, but check stored_duplicate arg first
-                else:
-                    if args.store_duplicates == True:
-                        duplicate_file.write(full_line)
-                        return rname
-                    else:
-                        return rname
-            
-            # There is no entry in the dict yet, this is a new read. We have to add it.        
-            else:
-                storing_dict[key_string] = (full_line, quality_score)
-                return rname
+        part_dir = tempfile.mkdtemp(prefix='deduper_parts_')
+
+    # The stats sent back by each worker are added up here
+    parallel_stats = {'stage_seconds': dict.fromkeys(run_stats.STAGES, 0.0), 'chromosomes': dict()}
+
+    # Keep track of where each chromosome starts and ends in the output and duplicate files
+    output_length = sum(len(header_line.encode()) for header_line in header_lines)
+    duplicate_length = 0
+    layout = {'header_length': output_length, 'chromosomes': list()}
+
+    try:
+        with multiprocessing.Pool(args.threads, initializer=set_worker_globals, initargs=(args, umi_set)) as pool:
+            # Send off every chromosome to the pool
+            results = [pool.apply_async(dedup_chromosome, (sam_path, rname, start, end, part_dir)) for rname, start, end in chunks]
+
+            # Stitch the parts back together as they come back in order
+            for (rname, start, end), result in zip(chunks, results):
+                part_output_name, part_duplicate_name, part_stats = result.get()
+                if part_stats != None:
+                    run_stats.merge_stats(parallel_stats, part_stats)
+                with open(part_output_name, 'r') as part_output:
+                    shutil.copyfileobj(part_output, output_file)
+                if duplicate_file != None:
+                    with open(part_duplicate_name, 'r') as part_duplicates:
+                        shutil.copyfileobj(part_duplicates, duplicate_file)
+
+                part_output_length = os.path.getsize(part_output_name)
+                part_duplicate_length = os.path.getsize(part_duplicate_name) if duplicate_file != None else 0
+                layout['chromosomes'].append({
+                    'rname': rname,
+                    'order': sq_order.get(rname, len(sq_order)),
+                    'input_start': start,
+                    'output_start': output_length,
+                    'output_end': output_length + part_output_length,
+                    'duplicate_start': duplicate_length,
+                    'duplicate_end': duplicate_length + part_duplicate_length,
+                })
+                output_length += part_output_length
+                duplicate_length += part_duplicate_length
+    finally:
+        shutil.rmtree(part_dir)
+
+    # Add in the time this process spent writing the parts out
+    if stats != None:
+        run_stats.merge_stats(parallel_stats, stats.to_dict())
+        return parallel_stats, layout
+    else:
+        return None, layout
 
-        
-        # If it isn't then throw it out.
+def run_numpy_engine(sam_lines, output_file, duplicate_file, umi_set):
+    """
+    Dedup the SAM lines with the NumPy batch engine, handing it args.chunk_size reads at a time. NumPy is only imported when
+    this engine is used, so the other engines start up without it.
+    """
+    import numpy_engine
+    engine = numpy_engine.NumpyDedupEngine(umi_set, args.umi == 'random', args.quality == True, output_file, duplicate_file,
+        verbose=True)
+
+    sam_lines = iter(sam_lines)
+    chunk_lines = list()
+    for sam_line in sam_lines:
+        # Write all of the header lines to the output file already. A BAM file of duplicates also needs the header.
+        if sam_line.startswith('@'):
+            output_file.write(sam_line)
+            if duplicate_file != None and args.output_format == 'bam':
+                duplicate_file.write(sam_line)
+
+        # The header is only at the top of the file, so the rest can be taken a whole chunk at a time
         else:
-            return rname
+            chunk_lines.append(sam_line)
+            break
 
-########################################## Script Logic
+    while True:
+        chunk_lines += itertools.islice(sam_lines, args.chunk_size - len(chunk_lines))
+        engine.add_reads(chunk_lines)
+        # The last chunk is the one that comes up short
+        if len(chunk_lines) < args.chunk_size:
+            break
+        chunk_lines = list()
 
-##### Create global variables
+    # Write out what is left
+    engine.flush()
 
-# Create a random run number for the ouptut
-run_id = random.randint(1, 100000)
+def get_work_dir(output_file):
+    """
+    The folder temporary files go in. They are written next to the output so that we don't fill up /tmp, the same as the
+    parts with -t. If we are writing to stdout then the temp folder is used.
+    """
+    if isinstance(output_file.name, str):
+        return os.path.dirname(os.path.abspath(output_file.name))
+    else:
+        return None
 
-# If -ds is flagged True then create this file.
-if args.store_duplicates == True:
-    duplicate_file = open(f'output/duplicates/{args.duplicate_output}.sam',
-    'w')
-else:
-    duplicate_file = None
+def sort_input(sam_lines, output_file):
+    """
+    Sort the SAM lines with external_sort, writing the sorted runs next to the output. Paired reads and -w are sorted on POS
+    since that is what the mate buffer and the window go by.
+    """
+    return external_sort.sort_sam_lines(sam_lines, args.sort_memory << 20, get_work_dir(output_file),
+        by_five_prime=args.paired != True and args.window == None)
 
-# Set past_chrome variable 
-past_chrome = 1
+def run_regions(sam_path, output_file, duplicate_file, umi_set):
+    """
+    Dedup only the reads in the regions of the BED file given to -rg. Each widened window around the regions is read by
+    seeking to it with the position bins of the index and deduped with its own dict engine, and only the reads with a POS
+    inside a region are written. The chromosomes come out in the order they are in the file.
+    """
+    # An index from before the position bins were added has to be made again
+    index = shards.load_index(sam_path)
+    if index == None or 'bins' not in index:
+        print('Index Written:', shards.write_index(sam_path), sep='\t', file=sys.stderr)
+        index = shards.load_index(sam_path)
+
+    # Write all of the header lines to the output file already. A BAM file of duplicates also needs the header.
+    for header_line in index['header_lines']:
+        output_file.write(header_line)
+        if duplicate_file != None and args.output_format == 'bam':
+            duplicate_file.write(header_line)
+
+    bed_regions = regions.read_bed(args.regions)
+    for rname in bed_regions:
+        if rname not in index['bins']:
+            print('No Reads For Region Chrom:', rname, sep='\t', file=sys.stderr)
+
+    with open(sam_path, 'rb') as sam_file:
+        for rname, chrom_start, chrom_end in index['chromosomes']:
+            if rname not in bed_regions:
+                continue
+
+            for window_start, window_end, window_regions in regions.make_windows(bed_regions[rname], args.region_margin):
+                engine = make_dict_engine(umi_set, regions.RegionFilter(output_file, window_regions),
+                    regions.RegionFilter(duplicate_file, window_regions) if duplicate_file != None else None, last_chrom=rname)
+
+                # Read from the start of the bin the window starts in until the window or the chromosome ends
+                sam_file.seek(regions.find_offset(index['bins'][rname], chrom_start, window_start, index['bin_size']))
+                for sam_line in read_lines_until(sam_file, chrom_end):
+                    pos = int(sam_line.split('\t', 4)[3])
+                    if pos > window_end:
+                        break
+                    if pos >= window_start:
+                        engine.add_read(sam_line)
+
+                engine.flush()
+
+            print('Regions Finished:', rname, sep='\t', file=sys.stderr)
+
+def run_serial(sam_path, output_file, duplicate_file, umi_set):
+    """Run through the SAM file one line at a time in this process"""
+    # The numpy engine handles the whole file itself
+    if args.engine == 'numpy':
+        with bam_io.open_sam_input(sam_path, args.bgzf_threads) as sam_file:
+            sam_lines = sam_file
+            if args.sort == True:
+                sam_lines = sort_input(sam_lines, output_file)
+            if args.pipeline == True:
+                sam_lines = pipeline.read_ahead(sam_lines)
+            run_numpy_engine(sam_lines, output_file, duplicate_file, umi_set)
+        return
+
+    # So does the mmap engine, which only needs the header to be written first
+    if args.engine == 'mmap':
+        with open(sam_path, 'rb') as sam_file, mmap.mmap(sam_file.fileno(), 0, access=mmap.ACCESS_READ) as sam_map:
+            header_lines, reads_start = sam_scanner.scan_header(sam_map)
+            for header_line in header_lines:
+                output_file.write(header_line)
+                if duplicate_file != None and args.output_format == 'bam':
+                    duplicate_file.write(header_line)
+
+            engine = mmap_engine.MmapDedupEngine(sam_map, umi_set, args.umi == 'random', args.quality == True, output_file,
+                duplicate_file, verbose=True)
+            try:
+                engine.dedup_range(reads_start, len(sam_map))
+                engine.flush()
+            finally:
+                engine.close()
+        return
+
+    # Load in the file, which can be SAM, BAM, or BGZF compressed SAM. With -os or -ck it is read as bytes so the offsets are known.
+    if args.offset_storage == True or args.checkpoint != None:
+        sam_file = open(sam_path, 'rb')
+        input_map = open_input_map(sam_file)
+        sam_lines = (sam_line.decode() for sam_line in sam_file)
+    else:
+        sam_file = bam_io.open_sam_input(sam_path, args.bgzf_threads)
+        input_map = None
+        sam_lines = sam_file
+
+    # Paired reads keep their own buffer of mates and dictionary of pairs, and single reads go through the dict engine
+    if args.paired == True:
+        engine = paired_engine.PairedDedupEngine(umi_set, args.umi == 'random', args.quality == True, output_file,
+            duplicate_file, verbose=True)
+    else:
+        engine = make_dict_engine(umi_set, output_file, duplicate_file, input_map)
+
+    # Sort the reads first if the input isn't sorted
+    if args.sort == True:
+        sam_lines = sort_input(sam_lines, output_file)
+
+    # Read the lines in their own thread so the reading overlaps with the deduping
+    if args.pipeline == True:
+        sam_lines = pipeline.read_ahead(sam_lines)
+
+    with sam_file:
+        line_number = 0
+        # Counting down to the next progress message is cheaper than a modulo on every line
+        next_progress = 100000
+        line_offset = 0
+
+        # Pick up from the start of the chromosome in the checkpoint
+        if resume_state != None:
+            line_offset = resume_state['input_offset']
+            sam_file.seek(line_offset)
+            print('Resuming At Chrom:', resume_state['chromosome'], sep='\t', file=sys.stderr)
+
+        # Iter through each line
+        for sam_line in sam_lines:
+            line_number += 1
+            if line_number == next_progress:
+                print(line_number, file=sys.stderr)
+                next_progress += 100000
+            # Read in lines that are only read lines
+            if not sam_line.startswith('@'):
+
+                # Run operation function
+                engine.add_read(sam_line, line_offset)
+
+
+            # Write all of the header lines to the output file already. A BAM file of duplicates also needs the header.
+            else:
+                output_file.write(sam_line)
+                if duplicate_file != None and args.output_format == 'bam':
+                    duplicate_file.write(sam_line)
 
-# Create UMI dictionary
-umi_created_set = instantiate_umi_set(args.umi)
+            line_offset += dict_engine.byte_length(sam_line)
 
-# Storing dict
-read_dict = dict()
 
-###### Run script
+        # Add the last 10 lines to the output, since the script doesn't trigger it
+        engine.flush()
 
-# Create the output file name
-output_name = re.sub('.sam', '', args.file).split('/')[-1]
+def dedup_file(entry):
+    """
+    Dedup one file of the manifest. This is what is run in each worker process with -m. The arguments for the file are swapped
+    in for the run and the summary of the file is returned, with any error put in the status so the other files still run.
+    """
+    global args
+    batch_args = args
+    args = batch.get_file_args(batch_args, entry)
 
-# Create the output_file to write for
-output_file = open(f'output/{output_name}_deduped.sam', 'w')
+    start = time.perf_counter()
+    extension = {'sam': 'sam', 'bam': 'bam', 'bgzf': 'sam.gz'}[args.output_format]
+    output_path, duplicate_path = get_output_paths(extension)
+    summary = {'input': args.file, 'output': output_path, 'kept_reads': 0, 'duplicate_reads': 'NA', 'status': 'ok'}
 
-# Set first chrom
-last_chrom = 1
+    output_file = None
+    duplicate_file = None
+    try:
+        # Check the file the same way it would be on its own, before any output is opened for it
+        check_args(args)
+
+        # The reads are counted on their way to the files
+        output_file = batch.CountingWriter(bam_io.open_sam_output(output_path, args.output_format, args.bgzf_threads))
+        if args.store_duplicates == True:
+            duplicate_file = batch.CountingWriter(bam_io.open_sam_output(duplicate_path, args.output_format, args.bgzf_threads))
+
+        # Write the output in its own thread so the writing overlaps with the deduping
+        if args.pipeline == True:
+            output_file.output_file = pipeline.QueuedWriter(output_file.output_file)
+            if duplicate_file != None:
+                duplicate_file.output_file = pipeline.QueuedWriter(duplicate_file.output_file)
+
+        # Each file gets its own whitelist with -lw
+        if args.learn_whitelist == True:
+            run_serial(args.file, output_file, duplicate_file, learn_umi_whitelist())
+        else:
+            run_serial(args.file, output_file, duplicate_file, umi_created_set)
 
-# Load in the file
-with open(args.file, 'r') as sam_file:
-    line_number = 0
-    # Iter through each line
-    for sam_line in sam_file:
-        line_number += 1
-        if line_number % 100000 == 0:
-            print(line_number)
-        # Read in lines that are only read lines
-        if r'@' not in sam_line:
-            
-            # Run operation function
-            last_chrom = store_or_check_read_against_dict(sam_line, read_dict, umi_created_set, output_file, duplicate_file, last_chrom)
+    except Exception as error:
+        summary['status'] = f'failed: {error}'
 
-        
-        # Write all of the header lines to the output file already
-        else:
-            output_file.write(sam_line)
+    finally:
+        if output_file != None:
+            output_file.close()
+            summary['kept_reads'] = output_file.reads
+        if duplicate_file != None:
+            duplicate_file.close()
+            summary['duplicate_reads'] = duplicate_file.reads
+        args = batch_args
 
+    summary['seconds'] = f'{time.perf_counter() - start:.2f}'
+    print('File Finished:', summary['input'], summary['status'], sep='\t', file=sys.stderr)
+    return summary
 
-# Add the last 10 lines to the output, since the script doesn't trigger it
-for read in read_dict:
-    output_file.write(read_dict[read][0])
+def run_batch(umi_set) -> int:
+    """
+    Dedup every file in the manifest across a pool of -t worker processes, which all share the UMI set that was loaded once.
+    The summary of each file is printed in the order of the manifest, and the number of files that failed is returned.
+    """
+    entries = batch.read_manifest(args.manifest)
 
-# Close the output file
-output_file.close()
+    with multiprocessing.Pool(min(args.threads, len(entries)), initializer=set_worker_globals, initargs=(args, umi_set)) as pool:
+        summaries = pool.map(dedup_file, entries, chunksize=1)
 
-if args.store_duplicates == True:
-    duplicate_file.close()
+    batch.print_summary(summaries, sys.stdout)
+    return sum(summary['status'] != 'ok' for summary in summaries)
 
+########################################## Script Logic
 
+if __name__ == '__main__':
+
+    # Load argparse info into a variable
+    args = get_args()
+    check_args(args)
+
+    # Start timing the whole run and set up the stats counters if they were asked for
+    start_time = time.perf_counter()
+    if args.stats != None:
+        install_stats()
+
+    ##### Create global variables
+
+    # Create UMI dictionary, with each known UMI given a small id for the packed keys, and every UMI within the correction
+    # distance of exactly one known UMI added under the id of that known UMI
+    umi_created_set = deduper_api.load_umis(args.umi, args.error_correct)
+
+    # Run every file in the manifest through the worker pool instead of a single file
+    if args.manifest != None:
+        sys.exit(run_batch(umi_created_set))
+
+    # Learn the UMIs from a sample of the reads, which are then used the same as a UMI file
+    if args.learn_whitelist == True:
+        umi_created_set = learn_umi_whitelist()
+
+    # The file ending that goes with each output format
+    extension = {'sam': 'sam', 'bam': 'bam', 'bgzf': 'sam.gz'}[args.output_format]
+
+    # Load the checkpoint to pick up from, and put back the chromosomes and stats from before it
+    if args.resume == True:
+        resume_state = checkpoint.read_checkpoint(args.checkpoint)
+        if resume_state == None:
+            print('No Checkpoint Found, Starting From The Beginning', file=sys.stderr)
+        elif resume_state['input'] != args.file:
+            raise ValueError(f'The checkpoint is for {resume_state["input"]}, not {args.file}. Please pass the same -f as before')
+        elif stats != None and 'chromosomes' in resume_state:
+            start_time -= resume_state['elapsed_seconds']
+            stats.stage_seconds.update(resume_state['stage_seconds'])
+            stats.chromosomes.update(resume_state['chromosomes'])
+
+    # Work out where the reads are written to
+    output_path, duplicate_path = get_output_paths(extension)
+
+    # If -ds is flagged True then create this file.
+    if args.store_duplicates == True:
+        duplicate_file = bam_io.open_sam_output(duplicate_path, args.output_format, args.bgzf_threads,
+            resume_state['duplicate_length'] if resume_state != None else None)
+    else:
+        duplicate_file = None
+
+    ###### Run script
+
+    # Create the output_file to write for
+    output_file = bam_io.open_sam_output(output_path, args.output_format, args.bgzf_threads,
+        resume_state['output_length'] if resume_state != None else None)
+
+    # Write the output in its own thread so the writing overlaps with the deduping
+    if args.pipeline == True:
+        output_file = pipeline.QueuedWriter(output_file)
+        if duplicate_file != None:
+            duplicate_file = pipeline.QueuedWriter(duplicate_file)
+
+    # Time the output writes for --stats
+    if stats != None:
+        output_file = run_stats.TimedWriter(output_file, stats)
+        if duplicate_file != None:
+            duplicate_file = run_stats.TimedWriter(duplicate_file, stats)
+
+    # Split the work up by chromosome if we were given more than one thread or only some of the chromosomes
+    if args.threads > 1 or args.shard != None:
+        stats_report, layout = run_parallel(args.file, output_file, duplicate_file, umi_created_set)
+    # Only read the target regions
+    elif args.regions != None:
+        run_regions(args.file, output_file, duplicate_file, umi_created_set)
+    else:
+        run_serial(args.file, output_file, duplicate_file, umi_created_set)
+        if stats != None:
+            stats_report = stats.to_dict()
+
+    # Close the output file
+    output_file.close()
+
+    if args.store_duplicates == True:
+        duplicate_file.close()
+
+    # The run is finished so there is nothing to pick up from anymore
+    if args.checkpoint != None:
+        checkpoint.remove_checkpoint(args.checkpoint)
+
+    # Write out the stats once everything has been written
+    wall_seconds = time.perf_counter() - start_time
+    if stats != None:
+        run_stats.write_stats(args.stats, stats_report, wall_seconds,
+            {'input': args.file, 'output': output_path, 'engine': args.engine, 'threads': args.threads})
+
+    # Record where everything is in the shard output for shards.py merge
+    if args.shard != None:
+        shard, shard_count = shards.parse_shard(args.shard)
+        shard_info = {
+            'input': os.path.abspath(args.file),
+            'shard': shard,
+            'shard_count': shard_count,
+            'output': os.path.abspath(output_path),
+            'duplicate_output': os.path.abspath(duplicate_path) if duplicate_path != None else None,
+        }
+        shard_info.update(layout)
+        if stats != None:
+            shard_info['stats'] = stats_report
+            shard_info['wall_seconds'] = wall_seconds
+            shard_info['peak_rss_mb'] = run_stats.peak_rss_mb()
+        shards.write_shard_info(output_path, shard_info)
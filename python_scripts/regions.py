@@ -0,0 +1,86 @@
+"""
+Dedup only the reads in a set of target regions (-rg) instead of the whole file. The position bins in the index from
+shards.py are used to seek close to each region, so the reads in between are never read.
+
+A read is in a region if its POS is. Whether a read is kept depends on the other reads with the same UMI, strand and 5'
+position, and those can have a POS up to a read span plus soft clipping away. So each region is widened by a margin on
+both sides, every read in the widened window is deduped, and only the kept reads and duplicates whose POS is in a region
+are written out. As long as the margin covers the longest reference span plus soft clipping of a read, the reads that are
+written are the same as the reads from those regions in a run over the whole file.
+"""
+
+import bisect
+
+
+def read_bed(bed_path: str) -> dict:
+    """
+    Read the regions of a BED file into {rname: [(first POS, last POS), ...]}. BED starts are 0 based and the ends are not
+    included, which is the same as 1 based POS from start + 1 to end. Overlapping and touching regions are joined.
+    """
+    regions = dict()
+    with open(bed_path) as bed_file:
+        for bed_line in bed_file:
+            if not bed_line.strip() or bed_line.startswith(('#', 'track', 'browser')):
+                continue
+            columns = bed_line.rstrip('\n').split('\t')
+            if len(columns) < 3:
+                raise ValueError(f'BED lines need the chromosome, start and end: {bed_line.strip()}')
+            regions.setdefault(columns[0], list()).append((int(columns[1]) + 1, int(columns[2])))
+
+    for rname, chrom_regions in regions.items():
+        chrom_regions.sort()
+        joined = list()
+        for first, last in chrom_regions:
+            if joined and first <= joined[-1][1] + 1:
+                joined[-1] = (joined[-1][0], max(joined[-1][1], last))
+            else:
+                joined.append((first, last))
+        regions[rname] = joined
+
+    return regions
+
+def make_windows(chrom_regions, margin: int):
+    """
+    Widen the regions of a chromosome by the margin and join the windows that overlap. Returns a list of
+    (window start, window end, [regions in the window]).
+    """
+    windows = list()
+    for first, last in chrom_regions:
+        window_start, window_end = max(first - margin, 1), last + margin
+        if windows and window_start <= windows[-1][1]:
+            windows[-1][1] = window_end
+            windows[-1][2].append((first, last))
+        else:
+            windows.append([window_start, window_end, [(first, last)]])
+    return [tuple(window) for window in windows]
+
+def find_offset(chrom_bins, chrom_start: int, position: int, bin_size: int) -> int:
+    """
+    Find where to start reading to get every read of the chromosome with a POS of at least position. chrom_bins is the
+    [bin, offset] of the first read in each bin from the index, so the start of the last bin at or before the position is
+    used, or the start of the chromosome if the position comes before every bin.
+    """
+    # Every [bin, offset] sorts before [bin of the position, infinity] if its bin is at or before the bin of the position
+    bin_number = bisect.bisect_right(chrom_bins, [position // bin_size, float('inf')]) - 1
+    if bin_number < 0:
+        return chrom_start
+    return chrom_bins[bin_number][1]
+
+
+class RegionFilter:
+    """Wraps an output file so only the reads with a POS inside one of the regions are written to it"""
+
+    def __init__(self, output_file, window_regions):
+        self.output_file = output_file
+        # Temporary files go next to the wrapped file, the same as without -rg
+        self.name = output_file.name
+        self.firsts = [first for first, last in window_regions]
+        self.lasts = [last for first, last in window_regions]
+
+    def in_regions(self, position: int) -> bool:
+        region_number = bisect.bisect_right(self.firsts, position) - 1
+        return region_number >= 0 and position <= self.lasts[region_number]
+
+    def write(self, text):
+        if self.in_regions(int(text.split('\t', 4)[3])):
+            self.output_file.write(text)
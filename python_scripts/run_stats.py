@@ -0,0 +1,196 @@
+"""
+Counters and timers for --stats. Nothing in the dedup logic itself has to know about them: the functions that parse a line
+and work out the 5' position are wrapped so they are timed and counted, the storing dictionary is swapped for a TimedDict,
+and the output files are wrapped in a TimedWriter. None of this is set up unless --stats is given, so a normal run pays
+nothing for it.
+"""
+
+import json
+import resource
+import sys
+import time
+
+
+# Stages that are timed
+STAGES = ('parsing', 'add_cigar_to_pos', 'dict_lookups', 'output_writes')
+
+# Counts that are kept for every chromosome while running. The reads that passed the UMI check are split into the unique
+# reads and the duplicates at the end.
+RUNNING_COUNTS = ('reads', 'passed_umi', 'unique', 'max_dict_size')
+
+# Counts that are reported for every chromosome
+CHROM_COUNTS = ('reads', 'unique', 'duplicates', 'discarded_umi', 'max_dict_size')
+
+
+class RunStats:
+    """Holds the stage timers and the counts for each chromosome"""
+
+    def __init__(self):
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.chromosomes = dict()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear everything out, which is done at the start of each chromosome in the worker processes. The timer dictionary is
+        cleared in place since the wrapped functions and files hold on to it.
+        """
+        for stage in STAGES:
+            self.stage_seconds[stage] = 0.0
+        self.chromosomes.clear()
+        self.current = None
+        self.current_rname = None
+
+    def start_chrom(self, rname: str):
+        """Point the counters at the chromosome of the read that was just parsed"""
+        if rname not in self.chromosomes:
+            self.chromosomes[rname] = dict.fromkeys(RUNNING_COUNTS, 0)
+        self.current = self.chromosomes[rname]
+        self.current_rname = rname
+
+    def timed_parser(self, parse_function):
+        """Wrap get_important_information so it is timed and every read is counted for its chromosome"""
+        stage_seconds = self.stage_seconds
+
+        def timed_parse(read_line):
+            start = time.perf_counter()
+            parsed = parse_function(read_line)
+            stage_seconds['parsing'] += time.perf_counter() - start
+
+            # parsed[3] is the RNAME
+            if parsed[3] != self.current_rname:
+                self.start_chrom(parsed[3])
+            self.current['reads'] += 1
+            return parsed
+
+        return timed_parse
+
+    def timed_cigar(self, cigar_function):
+        """Wrap add_cigar_to_pos, which is only called for reads whose UMI passed, so the rest are counted as discarded"""
+        stage_seconds = self.stage_seconds
+
+        def timed_add_cigar(cigar_variable, position, strand):
+            start = time.perf_counter()
+            updated_pos = cigar_function(cigar_variable, position, strand)
+            stage_seconds['add_cigar_to_pos'] += time.perf_counter() - start
+            self.current['passed_umi'] += 1
+            return updated_pos
+
+        return timed_add_cigar
+
+    def merge_keys(self, rname: str, merged_keys: int):
+        """
+        Keys that were spilled to disk with -mm and stored again, and UMIs that -dc clustered into another UMI, were counted as
+        unique when they were stored, so take those back off
+        """
+        self.chromosomes[rname]['unique'] -= merged_keys
+
+    def make_dict(self):
+        """Make the storing dictionary that times its lookups and counts the new keys"""
+        return TimedDict(self)
+
+    def to_dict(self) -> dict:
+        """The stats of this process, with the reads that passed the UMI check split into unique reads and duplicates"""
+        chromosomes = dict()
+        for rname, counts in self.chromosomes.items():
+            chromosomes[rname] = {
+                'reads': counts['reads'],
+                'unique': counts['unique'],
+                'duplicates': counts['passed_umi'] - counts['unique'],
+                'discarded_umi': counts['reads'] - counts['passed_umi'],
+                'max_dict_size': counts['max_dict_size'],
+            }
+        return {'stage_seconds': dict(self.stage_seconds), 'chromosomes': chromosomes}
+
+
+class TimedDict(dict):
+    """Dictionary that times the lookups and stores, counts the new keys, and keeps the most keys it has held per chromosome"""
+
+    def __init__(self, run_stats):
+        super().__init__()
+        self.run_stats = run_stats
+        self.stage_seconds = run_stats.stage_seconds
+
+    def __contains__(self, key):
+        start = time.perf_counter()
+        found = super().__contains__(key)
+        self.stage_seconds['dict_lookups'] += time.perf_counter() - start
+        return found
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        value = super().__getitem__(key)
+        self.stage_seconds['dict_lookups'] += time.perf_counter() - start
+        return value
+
+    def __setitem__(self, key, value):
+        start = time.perf_counter()
+        new_key = not super().__contains__(key)
+        super().__setitem__(key, value)
+        self.stage_seconds['dict_lookups'] += time.perf_counter() - start
+
+        if new_key:
+            counts = self.run_stats.current
+            counts['unique'] += 1
+            if len(self) > counts['max_dict_size']:
+                counts['max_dict_size'] = len(self)
+
+
+class TimedWriter:
+    """Wraps an output file so the time spent writing to it is added to the stats"""
+
+    def __init__(self, output_file, run_stats):
+        self.output_file = output_file
+        self.name = output_file.name
+        self.stage_seconds = run_stats.stage_seconds
+
+    def write(self, text):
+        start = time.perf_counter()
+        written = self.output_file.write(text)
+        self.stage_seconds['output_writes'] += time.perf_counter() - start
+        return written
+
+    def flush(self):
+        self.output_file.flush()
+
+    def close(self):
+        self.output_file.close()
+
+
+def merge_stats(total: dict, part: dict):
+    """Add the stats from one worker process into the total"""
+    for stage, seconds in part['stage_seconds'].items():
+        total['stage_seconds'][stage] += seconds
+    for rname, counts in part['chromosomes'].items():
+        if rname not in total['chromosomes']:
+            total['chromosomes'][rname] = dict.fromkeys(CHROM_COUNTS, 0)
+        for count_name, count in counts.items():
+            if count_name == 'max_dict_size':
+                total['chromosomes'][rname][count_name] = max(total['chromosomes'][rname][count_name], count)
+            else:
+                total['chromosomes'][rname][count_name] += count
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process and of the largest worker process, in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+def write_stats(stats_path: str, stats: dict, wall_seconds: float, run_info: dict, peak_rss=None):
+    """Add up the totals and write everything out as JSON. The peak RSS is that of this process unless one is given."""
+    totals = dict.fromkeys(('reads', 'unique', 'duplicates', 'discarded_umi'), 0)
+    for counts in stats['chromosomes'].values():
+        for count_name in totals:
+            totals[count_name] += counts[count_name]
+
+    report = dict(run_info)
+    report['wall_seconds'] = wall_seconds
+    report['reads_per_second'] = totals['reads'] / wall_seconds if wall_seconds > 0 else 0.0
+    report['peak_rss_mb'] = peak_rss if peak_rss != None else peak_rss_mb()
+    report['totals'] = totals
+    report['stage_seconds'] = stats['stage_seconds']
+    report['chromosomes'] = stats['chromosomes']
+
+    with open(stats_path, 'w') as stats_file:
+        json.dump(report, stats_file, indent=4)
+        stats_file.write('\n')
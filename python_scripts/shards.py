@@ -0,0 +1,229 @@
+"""
+Splits the work on one sorted SAM file across many jobs, for example the tasks of a SLURM array. Every chromosome is
+deduped on its own, so a job only needs to seek to the chromosomes it was given.
+
+    python python_scripts/shards.py index -f sample.sam
+    python python_scripts/powers_deduper.py -f sample.sam -sh 3/8       (one for each of the 8 tasks)
+    python python_scripts/shards.py merge -o sample_deduped.sam output/sample_deduped_shard*of8.sam.shard.json
+
+index scans the file once and writes the byte range of every chromosome next to it, along with where every BIN_SIZE bin of
+positions starts so -rg can seek straight to its regions. Each shard run gets the chromosomes for its shard, balanced by
+bytes, and writes a .shard.json file next to its output that records where each chromosome ended up. merge puts the shard
+outputs (and duplicates and stats) back together in @SQ order, which is the same as one run with -t.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import external_sort
+import run_stats
+
+
+# Files written next to the SAM file and next to each shard output
+INDEX_SUFFIX = '.chroms.json'
+SHARD_SUFFIX = '.shard.json'
+
+# Number of bases in each position bin of the index, which is how close -rg can seek to the start of a region
+BIN_SIZE = 16384
+
+# Size of the reads used to copy the shard outputs
+COPY_BUFFER = 1 << 20
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Index a sorted SAM file by chromosome, or merge the outputs of powers_deduper.py -sh')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='Write the byte range of every chromosome next to a sorted SAM file')
+    index_parser.add_argument('-f', '--file', help='Sorted plain SAM file to index', required=True, type=str)
+
+    merge_parser = subparsers.add_parser('merge', help='Put the outputs of every shard back together in @SQ order')
+    merge_parser.add_argument('shard_files', help='The .shard.json file of every shard', nargs='+', type=str)
+    merge_parser.add_argument('-o', '--output', help='Path to write the merged reads to', required=True, type=str)
+    merge_parser.add_argument('-do', '--duplicate_output', help='Path to write the merged duplicates to. The shards have to have \
+        been run with -ds. Default=None', default=None, type=str)
+    merge_parser.add_argument('-sj', '--stats', help='Path to write the combined stats to. The shards have to have been run with \
+        --stats. Default=None', default=None, type=str)
+    return parser.parse_args()
+
+def build_index(sam_path: str) -> dict:
+    """
+    Read through the SAM file once and find where every chromosome starts and ends. A chromosome that shows up a second time
+    means the file isn't sorted, which is caught here instead of in every shard. For every chromosome the offset of the first
+    read in each position bin that has reads is kept as [bin, offset], so a position can be found without reading the reads
+    before it.
+    """
+    header_lines = list()
+    chromosomes = list()
+    started_chroms = set()
+    bins = dict()
+    rname = None
+    start = 0
+    offset = 0
+
+    with open(sam_path, 'rb') as sam_file:
+        for sam_line in sam_file:
+            # The header is only at the top of the file
+            if rname == None and sam_line.startswith(b'@'):
+                header_lines.append(sam_line.decode())
+                offset += len(sam_line)
+                continue
+
+            columns = sam_line.split(b'\t', 4)
+            line_rname, position = columns[2], int(columns[3])
+            if line_rname != rname:
+                if rname != None:
+                    chromosomes.append((rname.decode(), start, offset))
+                if line_rname in started_chroms:
+                    raise ValueError(external_sort.UNSORTED_MESSAGE.format(line_rname.decode()))
+                started_chroms.add(line_rname)
+                rname = line_rname
+                start = offset
+                chrom_bins = bins[rname.decode()] = list()
+                last_position = 0
+
+            # The bins are only right if the reads are sorted by position
+            if position < last_position:
+                raise ValueError(f'The reads of chromosome {rname.decode()} are not sorted by position. Please sort the file first')
+            last_position = position
+            if not chrom_bins or position // BIN_SIZE > chrom_bins[-1][0]:
+                chrom_bins.append((position // BIN_SIZE, offset))
+            offset += len(sam_line)
+
+        if rname != None:
+            chromosomes.append((rname.decode(), start, offset))
+
+    return {'size': offset, 'header_lines': header_lines, 'chromosomes': chromosomes, 'bin_size': BIN_SIZE, 'bins': bins}
+
+def write_index(sam_path: str) -> str:
+    """Index the SAM file and write the index next to it, returning the path of the index"""
+    index = build_index(sam_path)
+    with open(sam_path + INDEX_SUFFIX, 'w') as index_file:
+        json.dump(index, index_file)
+    return sam_path + INDEX_SUFFIX
+
+def load_index(sam_path: str):
+    """Load the whole index of the SAM file, or None if it hasn't been indexed. An index for a file of a different size is out of date."""
+    if not os.path.exists(sam_path + INDEX_SUFFIX):
+        return None
+    with open(sam_path + INDEX_SUFFIX) as index_file:
+        index = json.load(index_file)
+    if index['size'] != os.path.getsize(sam_path):
+        raise ValueError(f'The index {sam_path + INDEX_SUFFIX} is out of date. Please run shards.py index -f {sam_path} again')
+    return index
+
+def read_index(sam_path: str):
+    """Read the chromosomes of the index back in as (header lines, [(rname, start, end), ...]), or None if it hasn't been indexed"""
+    index = load_index(sam_path)
+    if index == None:
+        return None
+    return index['header_lines'], [tuple(chromosome) for chromosome in index['chromosomes']]
+
+def parse_shard(shard_text: str):
+    """Turn the i/N of -sh into (i, N), where i goes from 1 to N"""
+    try:
+        shard, shard_count = [int(number) for number in shard_text.split('/')]
+    except ValueError:
+        raise ValueError(f'-sh has to be given as i/N, for example 1/8, not {shard_text}')
+    if shard_count < 1 or not 1 <= shard <= shard_count:
+        raise ValueError(f'The shard in -sh {shard_text} has to be from 1 to {shard_count}')
+    return shard, shard_count
+
+def shard_chunks(chunks, shard: int, shard_count: int):
+    """
+    Pick out the chromosomes for one shard. The biggest chromosome goes to the shard with the fewest bytes so far, then the
+    next biggest and so on, with ties going to the chromosome that comes first in the file and the lowest shard. Every task
+    works this out the same way from the same index, so they all agree on who gets what without talking to each other.
+    """
+    shard_bytes = [0] * shard_count
+    assigned = set()
+    for chunk_number, (rname, start, end) in sorted(enumerate(chunks), key=lambda item: (item[1][1] - item[1][2], item[0])):
+        smallest = shard_bytes.index(min(shard_bytes))
+        shard_bytes[smallest] += end - start
+        if smallest == shard - 1:
+            assigned.add(chunk_number)
+
+    return [chunk for chunk_number, chunk in enumerate(chunks) if chunk_number in assigned]
+
+def write_shard_info(output_path: str, shard_info: dict):
+    """Write the layout of a shard output next to it for merge"""
+    with open(output_path + SHARD_SUFFIX, 'w') as shard_file:
+        json.dump(shard_info, shard_file, indent=4)
+        shard_file.write('\n')
+
+def copy_range(from_file, to_file, start: int, end: int):
+    """Copy the bytes from start to end of one file to the end of another"""
+    from_file.seek(start)
+    left = end - start
+    while left > 0:
+        data = from_file.read(min(left, COPY_BUFFER))
+        if not data:
+            raise ValueError(f'{from_file.name} is shorter than its .shard.json says. Please run that shard again')
+        to_file.write(data)
+        left -= len(data)
+
+def merge_shards(shard_paths, output_path: str, duplicate_path=None, stats_path=None):
+    """
+    Put the shard outputs back together. The header comes from the first shard and the chromosomes are copied over in the
+    @SQ order of the header, with chromosomes not in the header at the end in the order they were found in the input.
+    """
+    shard_infos = list()
+    for shard_path in shard_paths:
+        with open(shard_path) as shard_file:
+            shard_infos.append(json.load(shard_file))
+    shard_infos.sort(key=lambda shard_info: shard_info['shard'])
+
+    # Every shard of the same input has to be there exactly once
+    shard_count = shard_infos[0]['shard_count']
+    if any(shard_info['input'] != shard_infos[0]['input'] for shard_info in shard_infos):
+        raise ValueError('The shards are not all from the same input file')
+    if [shard_info['shard'] for shard_info in shard_infos] != list(range(1, shard_count + 1)) or \
+        any(shard_info['shard_count'] != shard_count for shard_info in shard_infos):
+        raise ValueError(f'Every shard from 1 to {shard_count} has to be passed to merge exactly once')
+    if duplicate_path != None and any(shard_info['duplicate_output'] == None for shard_info in shard_infos):
+        raise ValueError('-do needs the duplicates of every shard. Please run the shards with -ds')
+    if stats_path != None and any('stats' not in shard_info for shard_info in shard_infos):
+        raise ValueError('-sj needs the stats of every shard. Please run the shards with --stats')
+
+    # Every chromosome of every shard, in the order they go in the merged output
+    pieces = [(piece['order'], piece['input_start'], shard_number, piece) for shard_number, shard_info in enumerate(shard_infos)
+        for piece in shard_info['chromosomes']]
+    pieces.sort(key=lambda piece: piece[:2])
+
+    outputs = [('output', 'output_start', 'output_end', output_path)]
+    if duplicate_path != None:
+        outputs.append(('duplicate_output', 'duplicate_start', 'duplicate_end', duplicate_path))
+
+    for file_key, start_key, end_key, merged_path in outputs:
+        shard_files = [open(shard_info[file_key], 'rb') for shard_info in shard_infos]
+        try:
+            with open(merged_path, 'wb') as merged_file:
+                # The shard outputs all start with the same header
+                if file_key == 'output':
+                    copy_range(shard_files[0], merged_file, 0, shard_infos[0]['header_length'])
+                for order, input_start, shard_number, piece in pieces:
+                    copy_range(shard_files[shard_number], merged_file, piece[start_key], piece[end_key])
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+
+    # The shards ran side by side, so the run took as long as the slowest one
+    if stats_path != None:
+        merged_stats = {'stage_seconds': dict.fromkeys(run_stats.STAGES, 0.0), 'chromosomes': dict()}
+        for shard_info in shard_infos:
+            run_stats.merge_stats(merged_stats, shard_info['stats'])
+        run_stats.write_stats(stats_path, merged_stats, max(shard_info['wall_seconds'] for shard_info in shard_infos),
+            {'input': shard_infos[0]['input'], 'output': output_path, 'shards': shard_count},
+            max(shard_info['peak_rss_mb'] for shard_info in shard_infos))
+
+
+if __name__ == '__main__':
+
+    args = get_args()
+
+    if args.command == 'index':
+        print('Index Written:', write_index(args.file), sep='\t', file=sys.stderr)
+    else:
+        merge_shards(args.shard_files, args.output, args.duplicate_output, args.stats)
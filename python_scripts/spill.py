@@ -0,0 +1,115 @@
+"""
+Spill to disk for the dict engine with -mm. Once the reads held in the dictionary go over the memory budget, the whole
+dictionary is sorted by key and written to a run file, and the dictionary starts over empty. When the chromosome is finished
+the runs are merged by key so that copies of the same key in different runs are still found: the first read is kept, or with
+quality the best read with ties going to the first one, the same as when everything is held in memory. The kept reads are
+then put back in the order their keys were first seen, with a second disk backed sort if they don't fit in the budget, so
+the output is the same as without -mm. Only the duplicates that were split across runs come out in a different order.
+"""
+
+import heapq
+import os
+import tempfile
+
+
+# Rough number of bytes Python uses for each dictionary entry on top of the read itself: the slot in the dictionary, the
+# packed key, the tuple, and the string and float objects
+ENTRY_OVERHEAD = 200
+
+
+def write_key_run(entries, spill_dir) -> str:
+    """Write a run of (key text, sequence number, score, line) that is already sorted, returning the path of the run"""
+    run_descriptor, run_path = tempfile.mkstemp(prefix='deduper_spill_', suffix='.run', dir=spill_dir)
+    with os.fdopen(run_descriptor, 'w') as run_file:
+        for key_text, sequence, score, read_line in entries:
+            # Every line is stored with a newline so the run can be read back in one line at a time. Only the last line of
+            # the input can be missing it.
+            if not read_line.endswith('\n'):
+                read_line += '\n'
+            run_file.write(f'{key_text}\t{sequence}\t{score!r}\t{read_line}')
+    return run_path
+
+def read_key_run(run_path: str):
+    """Read a run back in as (key text, sequence number, score, line)"""
+    with open(run_path) as run_file:
+        for run_line in run_file:
+            key_text, sequence, score, read_line = run_line.split('\t', 3)
+            yield key_text, int(sequence), None if score == 'None' else float(score), read_line
+
+def resolve_runs(run_paths, quality: bool):
+    """
+    Merge the runs by key and yield (sequence number of the key, kept line, duplicate lines) for every key. The runs are
+    merged on (key text, sequence number), so the reads for a key come in the order they were stored.
+    """
+    current_key = None
+    for key_text, sequence, score, read_line in heapq.merge(*[read_key_run(run_path) for run_path in run_paths]):
+        if key_text != current_key:
+            if current_key != None:
+                yield first_sequence, kept_line, duplicate_lines
+            current_key, first_sequence, kept_line, kept_score, duplicate_lines = key_text, sequence, read_line, score, list()
+
+        # A later read only takes the place of the kept read if its quality is better
+        elif quality == True and score > kept_score:
+            duplicate_lines.append(kept_line)
+            kept_line, kept_score = read_line, score
+
+        else:
+            duplicate_lines.append(read_line)
+
+    if current_key != None:
+        yield first_sequence, kept_line, duplicate_lines
+
+def write_order_run(order_reads, spill_dir) -> str:
+    """
+    Sort a run of (sequence number, line) and write it out, returning the path of the run. The lines all come out of the key
+    runs so they already end in a newline.
+    """
+    order_reads.sort()
+    run_descriptor, run_path = tempfile.mkstemp(prefix='deduper_spill_', suffix='.run', dir=spill_dir)
+    with os.fdopen(run_descriptor, 'w') as run_file:
+        for sequence, read_line in order_reads:
+            run_file.write(f'{sequence}\t{read_line}')
+    return run_path
+
+def read_order_run(run_path: str):
+    """Read a run back in as (sequence number, line)"""
+    with open(run_path) as run_file:
+        for run_line in run_file:
+            sequence, read_line = run_line.split('\t', 1)
+            yield int(sequence), read_line
+
+def sort_by_sequence(sequence_reads, memory_budget: int, spill_dir=None):
+    """
+    Yield the lines of (sequence number, line) in the order of their sequence numbers. They are sorted in memory unless
+    they add up to more than memory_budget bytes, in which case sorted runs are written to spill_dir and merged.
+    """
+    order_reads = list()
+    order_bytes = 0
+    run_paths = list()
+
+    try:
+        for sequence, read_line in sequence_reads:
+            order_reads.append((sequence, read_line))
+            order_bytes += len(read_line) + ENTRY_OVERHEAD
+            if order_bytes > memory_budget:
+                run_paths.append(write_order_run(order_reads, spill_dir))
+                order_reads = list()
+                order_bytes = 0
+
+        # Everything fit in memory
+        if not run_paths:
+            order_reads.sort()
+            for sequence, read_line in order_reads:
+                yield read_line
+            return
+
+        if order_reads:
+            run_paths.append(write_order_run(order_reads, spill_dir))
+        order_reads = list()
+
+        for sequence, read_line in heapq.merge(*[read_order_run(run_path) for run_path in run_paths]):
+            yield read_line
+
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
@@ -0,0 +1,57 @@
+"""
+Directional clustering of random UMIs, the same idea as the directional method in UMI-tools. The UMIs seen at one strand
+and 5' position are joined into one cluster when they are one mismatch apart and the UMI with more reads has at least
+ratio times the reads of the other one (minus one). The UMI with the most reads is the head of the cluster and every
+other UMI in it is treated as a sequencing error of the head.
+
+The UMIs that are one mismatch apart are found with an index instead of comparing every pair of UMIs. Two UMIs of the same
+length are one mismatch apart only when they match after the same single base is taken out of both, so each UMI is put in
+one bucket for every base it has, keyed by the base that was taken out and what is left.
+"""
+
+import collections
+
+
+def build_neighbor_index(umis) -> dict:
+    """Put every UMI into one bucket for each of its bases, keyed by (length, base taken out, UMI without that base)"""
+    buckets = collections.defaultdict(list)
+    for umi in umis:
+        for position in range(len(umi)):
+            buckets[(len(umi), position, umi[:position] + umi[position + 1:])].append(umi)
+    return buckets
+
+def one_mismatch_neighbors(umis) -> dict:
+    """Return every UMI mapped to the list of UMIs that are exactly one mismatch away from it"""
+    neighbors = {umi: list() for umi in umis}
+    for bucket in build_neighbor_index(umis).values():
+        # Every UMI in a bucket is one mismatch away from every other UMI in it, and a pair only ever shares one bucket
+        if len(bucket) > 1:
+            for umi in bucket:
+                neighbors[umi].extend(other_umi for other_umi in bucket if other_umi != umi)
+    return neighbors
+
+def directional_clusters(umi_counts: dict, ratio: float) -> dict:
+    """
+    Cluster the UMIs at one position. umi_counts holds the number of reads for every UMI, and every UMI is returned mapped to
+    the head of its cluster. The UMIs are taken in order of most reads (ties go by the UMI itself so the result is the same
+    on every run), and each one that isn't in a cluster yet starts a new one. The cluster then takes in every neighbor that
+    it has an edge to, and every neighbor of those, and so on.
+    """
+    neighbors = one_mismatch_neighbors(umi_counts)
+    cluster_heads = dict()
+
+    for head in sorted(umi_counts, key=lambda umi: (-umi_counts[umi], umi)):
+        if head in cluster_heads:
+            continue
+        cluster_heads[head] = head
+
+        to_visit = [head]
+        while to_visit:
+            umi = to_visit.pop()
+            for neighbor in neighbors[umi]:
+                # There is an edge from umi to neighbor only when umi has enough more reads than the neighbor
+                if neighbor not in cluster_heads and umi_counts[umi] >= ratio * umi_counts[neighbor] - 1:
+                    cluster_heads[neighbor] = head
+                    to_visit.append(neighbor)
+
+    return cluster_heads
@@ -0,0 +1,100 @@
+"""
+Packs the duplicate key (UMI, strand, 5' position) into a single integer instead of building a key string for every read.
+The 5' position takes the low 33 bits, the strand takes the next bit, and the UMI takes the bits above that. Known UMIs
+are given small integer ids, and random UMIs are packed 2 bits to a base. UMIs that are too long to pack (or have bases
+other than ACGT) fall back to a tuple key, which can never be equal to one of the integer keys.
+"""
+
+import functools
+import itertools
+import re
+
+
+# How the key is laid out. The 5' position is shifted up so that soft clipping before base 1 stays positive.
+POSITION_BIAS = 1 << 31
+STRAND_SHIFT = 33
+UMI_SHIFT = 34
+
+# 2 bits for every base plus a leading 1 so that UMIs of different lengths don't collide, and still fit in a signed 64 bit int
+MAX_PACKED_UMI_LENGTH = 14
+
+# Turns the bases into base 4 digits so int() can pack them
+BASE_DIGITS = str.maketrans('ACGT', '0123')
+PACKABLE_UMI = re.compile(f'[ACGT]{{1,{MAX_PACKED_UMI_LENGTH}}}')
+
+# Bases a sequencing error can turn a UMI base into
+ERROR_BASES = 'ACGTN'
+
+
+def number_umis(umi_set) -> dict:
+    """Give every known UMI a small integer id. The UMIs are sorted first so the ids are the same on every run."""
+    return {umi: umi_id for umi_id, umi in enumerate(sorted(umi_set))}
+
+def hamming_neighbors(umi: str, max_distance: int):
+    """Yield every UMI that is at least 1 and at most max_distance substitutions away from umi"""
+    for distance in range(1, max_distance + 1):
+        for positions in itertools.combinations(range(len(umi)), distance):
+            # Every base at each of the chosen positions has to be changed to something else
+            choices = [[base for base in ERROR_BASES if base != umi[position]] for position in positions]
+            for bases in itertools.product(*choices):
+                neighbor = list(umi)
+                for position, base in zip(positions, bases):
+                    neighbor[position] = base
+                yield ''.join(neighbor)
+
+def add_umi_neighbors(umi_ids: dict, max_distance: int) -> dict:
+    """
+    Build the lookup for UMI correction once up front, so correcting a read is still one dict lookup. Every UMI within
+    max_distance of exactly one known UMI is given the id of that known UMI. UMIs that are close to more than one known UMI
+    are left out, so they are thrown out the same as any other unknown UMI. The known UMIs always keep their own ids.
+    """
+    neighbor_ids = dict()
+    ambiguous = set()
+    for umi, umi_id in umi_ids.items():
+        for neighbor in hamming_neighbors(umi, max_distance):
+            if neighbor in neighbor_ids and neighbor_ids[neighbor] != umi_id:
+                ambiguous.add(neighbor)
+            neighbor_ids[neighbor] = umi_id
+
+    for neighbor in ambiguous:
+        del neighbor_ids[neighbor]
+
+    neighbor_ids.update(umi_ids)
+    return neighbor_ids
+
+@functools.lru_cache(maxsize=1 << 16)
+def pack_umi(umi: str):
+    """Pack a UMI 2 bits to a base. Returns None if the UMI can't be packed."""
+    if PACKABLE_UMI.fullmatch(umi) == None:
+        return None
+    return int('1' + umi.translate(BASE_DIGITS), 4)
+
+def unpack_umi(umi_code: int) -> str:
+    """Turn a UMI packed by pack_umi back into its bases"""
+    bases = list()
+    while umi_code > 1:
+        bases.append('ACGT'[umi_code & 3])
+        umi_code >>= 2
+    return ''.join(reversed(bases))
+
+def split_key(key):
+    """
+    Split a key made by pack_key for a random UMI back into the UMI and the (reverse, 5' position) it was made from. Known
+    UMIs are stored as ids and can't be split back out.
+    """
+    if isinstance(key, tuple):
+        return key[0], (key[1], key[2])
+    return unpack_umi(key >> UMI_SHIFT), (bool((key >> STRAND_SHIFT) & 1), (key & ((1 << STRAND_SHIFT) - 1)) - POSITION_BIAS)
+
+def pack_key(umi: str, reverse: bool, five_prime: int, umi_ids: dict):
+    """
+    Build the duplicate key for a read. If the UMI has an id in umi_ids then that is used, otherwise the UMI itself is packed.
+    A tuple is returned for UMIs that can't be packed.
+    """
+    umi_code = umi_ids.get(umi)
+    if umi_code == None:
+        umi_code = pack_umi(umi)
+        if umi_code == None:
+            return (umi, reverse, five_prime)
+
+    return (umi_code << UMI_SHIFT) | (reverse << STRAND_SHIFT) | (five_prime + POSITION_BIAS)
@@ -0,0 +1,108 @@
+"""
+Learns a UMI whitelist for runs without a UMI file (-lw). Instead of reading the whole file, reads are sampled from evenly
+spaced byte offsets: the reader seeks to each offset, skips the partial line it landed in, and takes the next few reads. The
+UMIs of the sampled reads are counted and the whitelist is cut at the knee of the count curve, which is where the real UMIs
+with many reads each give way to the long tail of UMIs with sequencing errors in them. The main pass then filters
+against the whitelist the same as with a UMI file. If the counts have no knee there is nothing to cut, so no whitelist is
+learned and the run keeps treating the UMIs as random.
+"""
+
+import collections
+import os
+
+
+# Smallest drop in count from one UMI to the next that is taken as the knee, and the fewest sampled reads the UMI before
+# the drop needs
+MIN_KNEE_RATIO = 3.0
+MIN_KNEE_COUNT = 5
+
+
+def sample_umis(sam_path: str, sample_reads: int, reads_per_offset=20):
+    """
+    Count the UMIs of about sample_reads reads taken reads_per_offset at a time from evenly spaced offsets of a plain SAM
+    file. When the offsets are closer together than reads_per_offset reads, an offset that lands in reads that were already
+    sampled picks up after them instead, so no read is counted twice. UMIs with an N in them are never kept so they aren't
+    counted.
+    """
+    umi_counts = collections.Counter()
+
+    with open(sam_path, 'rb') as sam_file:
+        # Find where the reads start
+        while True:
+            reads_start = sam_file.tell()
+            sam_line = sam_file.readline()
+            if not sam_line.startswith(b'@'):
+                break
+
+        file_size = sam_file.seek(0, os.SEEK_END)
+        offset_count = max(1, sample_reads // reads_per_offset)
+        stride = max(1, (file_size - reads_start) // offset_count)
+
+        # Where the reads that were sampled so far end
+        sampled_end = reads_start
+
+        for offset in range(reads_start, file_size, stride):
+            # Pick up after the last sampled read if we landed in the reads that were already sampled
+            if offset <= sampled_end:
+                sam_file.seek(sampled_end)
+
+            # Otherwise skip over the partial line we landed in, unless we landed on the start of a line
+            else:
+                sam_file.seek(offset - 1)
+                sam_file.readline()
+
+            for line_number in range(reads_per_offset):
+                sam_line = sam_file.readline()
+                if not sam_line:
+                    break
+                umi = sam_line.split(b'\t', 1)[0].split(b':')[-1].decode()
+                if 'N' not in umi:
+                    umi_counts[umi] += 1
+
+            sampled_end = sam_file.tell()
+
+    return umi_counts
+
+def knee_threshold(umi_counts):
+    """
+    Find the knee of the count curve, with the UMIs ranked from the most reads to the fewest. On a log scale the knee is the
+    steepest drop from one UMI to the next, and the count just before it is the smallest count that makes it onto the
+    whitelist. Drops from a UMI with fewer than MIN_KNEE_COUNT sampled reads are only noise so they are left out. If no
+    drop is at least MIN_KNEE_RATIO then there is no knee and None is returned, since any cut would throw out real UMIs.
+    """
+    counts = sorted(umi_counts.values(), reverse=True)
+
+    best_rank, best_ratio = None, 0.0
+    for rank in range(len(counts) - 1):
+        if counts[rank] < MIN_KNEE_COUNT:
+            break
+        ratio = counts[rank] / counts[rank + 1]
+        if ratio > best_ratio:
+            best_rank, best_ratio = rank, ratio
+
+    if best_ratio < MIN_KNEE_RATIO:
+        return None
+    return counts[best_rank]
+
+def learn_whitelist(sam_path: str, sample_reads: int):
+    """
+    Sample the SAM file and return the learned whitelist, the number of UMIs seen, and the fraction of sampled reads it covers.
+    The whitelist is None if the counts have no knee.
+    """
+    umi_counts = sample_umis(sam_path, sample_reads)
+    if not umi_counts:
+        raise ValueError(f'There were no reads with a usable UMI in the sample of {sam_path}, so no whitelist could be learned')
+
+    threshold = knee_threshold(umi_counts)
+    if threshold == None:
+        return None, len(umi_counts), 1.0
+
+    whitelist = sorted(umi for umi, count in umi_counts.items() if count >= threshold)
+    covered = sum(umi_counts[umi] for umi in whitelist) / sum(umi_counts.values())
+    return whitelist, len(umi_counts), covered
+
+def write_whitelist(whitelist, whitelist_path: str):
+    """Write the whitelist out as a UMI file separated by newlines, which can be passed to -u on later runs"""
+    with open(whitelist_path, 'w') as whitelist_file:
+        for umi in whitelist:
+            whitelist_file.write(umi + '\n')